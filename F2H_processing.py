@@ -2,79 +2,143 @@
 ### automatically identifies nucleus and array and outputs the area, mean and median intensity of each feature identified to a csv file
 ### the ROIs for each respective image are saved to the output directory to allow confirmation of accurate feature calling
 
-#@ File[] (label="Select the input directories", style="directories") inputDir
+#@ File[] (label="Select the input directories", style="directories", required=false) inputDir
+#@ File (label="Parameter file (optional, for unattended runs)", style="file", required=false) parameterFile
+#@ File (label="Cache directory (optional)", style="directory", required=false) cacheDir
+#@ Integer (label="Cache size limit (GB)", value=20, min=1) cacheLimit
+#@ Boolean (label="Show results table when finished", value=false) showResults
+#@ Boolean (label="Also collect the rois of all images in one F2H_rois.zip", value=false) collectRois
 
 #ImageJ stuff
 from ij import IJ, ImagePlus, Prefs, WindowManager
 from ij.process import ImageStatistics as IS
-from ij.io import FileSaver
-from ij.plugin import ImageCalculator, filter
-from ij.plugin.frame import RoiManager
+from ij.process import ByteProcessor, ColorProcessor, ShortProcessor, ImageProcessor, ImageConverter
+from ij.plugin import Binner, ContrastEnhancer, ImageCalculator, RoiScaler, filter
+from ij.plugin.filter import GaussianBlur, LutApplier
 from ij.measure import ResultsTable
 from ij.gui import Overlay, Roi, ShapeRoi, GenericDialog
 
-# czi and image import stuff
-from loci.plugins import BF
-from loci.plugins.in import ImporterOptions
-from loci.formats.in import ZeissCZIReader, DynamicMetadataOptions
+#Fiji auto threshold plugin
+from fiji.threshold import Auto_Threshold
 
 #python stuff (regular expressions etc.)
 import re
-import collections
+import bisect
+import json
+import csv
+import hashlib
+import itertools
+import math
+import threading
 
 #file management
-from java.io import File
-from java.lang import System
+from java.io import File, FileInputStream
+from java.util import Properties
+from java.lang import System, Runtime
 from java.text import SimpleDateFormat
 
+#caching
+from java.io import BufferedOutputStream, FileOutputStream
+from java.util import Collections
+from java.util.zip import ZipEntry, ZipFile, ZipOutputStream
+from jarray import zeros
+
+#helpers shared with subcell_loc.py, from Fiji.app/jars/Lib/plugin_common.py
+from plugin_common import analyzeParticles, atomicMove, backgroundMask, cziAccess, getCZIinfo, imageLog, labelImage, overlapArea, \
+	resultCache, resultsSaver, resultsWriter, roiIndex, roiMask, roiStatistics, roiZipWriter, stageProfile, uniquePath
+
+#parallel processing
+from java.util.concurrent import Callable, Executors
+
 #GUI stuff
-from java.awt import GridBagLayout, GridBagConstraints
+from java.awt import GridBagLayout, GridBagConstraints, GraphicsEnvironment, Rectangle
 from javax.swing import JDialog, JFrame, JPanel, JLabel, JTextField, BorderFactory, JButton
 
+#columns of the results table, one row per roi and channel
+resultColumns = ["Path", "Date", "Name", "Channel", "ROI", "Area", "Mean", "Median"]
+#parameters that can be given as lists in a parameter file to sweep them; they lead each row of the sweep table
+sweepLabels = ["lower nuclear area", "upper nuclear area", "lower array area", "upper array area", "lower threshold", "upper threshold"]
+#sigma (in pixels) of the blur applied to the nuclear plane before the nuclei are called
+nucleusSigma = 3
+
 class frameMaker():
+	"""as dictionaries are not ordered in python 2, idList gives the order of the sections built by idBuilder"""
+	idList = ['channel', 'nuc', 'array', 'thresh', 'tiles', 'workers']
+
 	def __init__(self):
 		self.Imageinfo = {}
-		self.dialog = JDialog()
+		self.dialog = None
 		self.panel = JPanel(border = BorderFactory.createEmptyBorder(10,10,10,10))
 		self.out = {}
 		
 	def okayPressed(self, event):
-		length = len(self.panel.getComponents())
+		components = self.panel.getComponents()
+		#labels are located one index behind their respective textboxes in the panel
+		values = [(components[i-1].getText(), components[i].getText()) for i in range(1, len(components)) if isinstance(components[i], JTextField)]
+		out = self.validate(values)
+		if out is None:
+			return
+		self.out = out
+		print self.out, "okaypressed"
+		self.dialog.dispose()
+
+	def validate(self, values, sweep = False):
+		"""check (label, text) pairs against the permitted range of each parameter; with sweep, sweepLabels may be lists. None after reporting an invalid value"""
+		out = {}
 		upperFinder = re.compile("^upper.*")
-		for i in range(1, length):
-			item = self.panel.getComponents()[i]
-			if not isinstance(item, JTextField):
-				continue
-			label = self.panel.getComponents()[i-1].getText() #labels are located one index behind their respective textboxes in the panel
+		largest = lambda value: max(value) if isinstance(value, list) else value
+		for i, (label, text) in enumerate(values):
 			if label in ["nuclear", "prey", "bait"]:
 				bounds = [1, self.Imageinfo['SizeC']]
 			elif label in ["lower nuclear area", "upper nuclear area"]:
 				bounds = [1, self.Imageinfo['SizeX']*self.Imageinfo['SizeY']]
 			elif label in ["lower array area", "upper array area"]:
-				bounds = [1, self.out['lower nuclear area']]
-			elif label in ["lower thresh", "upper thresh"]:
+				bounds = [1, largest(out['lower nuclear area'])]
+			elif label in ["lower threshold", "upper threshold"]:
 				bounds = [0, 255]
-			try:
-				val = int(item.getText())
-			except:
-				IJ.log("Non-numeric input for {0}. Please input an integer between {1} and {2}.".format(label, bounds[0], bounds[1]))
-				IJ.error("Non-numeric input for {0}. Please input an integer between {1} and {2}.".format(label, bounds[0], bounds[1]))
-				return
-			if upperFinder.match(label): #check if label begins with upper
-				lowerVal = int(self.panel.getComponents()[i-2].getText())
-				if val <= lowerVal:#the upper value of any pair of upper and lower values cannot be less than or equal to the lower value
-					sectionLabel = label.split("upper ")[1]
-					IJ.log("Input value outside permitted range. Upper {0} must be greater than lower {0}.".format(sectionLabel))
-					IJ.error("Input value outside permitted range. Upper {0} must be greater than lower {0}.".format(sectionLabel))
-					return
-			if bounds[0] <= val <= bounds[1]:
-				self.out[label] = val
-			else:
-				IJ.log("Input value {0} outside of range. Please input an integer between {1} and {2} in {3}".format(val, bounds[0], bounds[1], label))
-				IJ.error("Input value {0} outside of range. Please input an integer between {1} and {2} in {3}".format(val,bounds[0], bounds[1], label))
-				return
-		print self.out, "okaypressed"
-		self.dialog.dispose()
+			elif label == "nucleus downsampling":
+				bounds = [1, 8]
+			elif label in ["tile size", "tile overlap"]:
+				bounds = [0, 65536]
+			elif label == "parallel images":
+				bounds = [1, Runtime.getRuntime().availableProcessors()]
+			swept = sweep and label in sweepLabels
+			if swept and isinstance(text, basestring) and "," in text:
+				text = [part.strip() for part in text.split(",")]
+			vals = []
+			for part in (text if swept and isinstance(text, list) else [text]):
+				try:
+					val = int(part)
+				except:
+					IJ.log("Non-numeric input {0} for {1}. Please input an integer between {2} and {3}.".format(part, label, bounds[0], bounds[1]))
+					IJ.error("Non-numeric input {0} for {1}. Please input an integer between {2} and {3}.".format(part, label, bounds[0], bounds[1]))
+					return None
+				if bounds[0] <= val <= bounds[1]:
+					vals.append(val)
+				else:
+					IJ.log("Input value {0} outside of range. Please input an integer between {1} and {2} in {3}".format(val, bounds[0], bounds[1], label))
+					IJ.error("Input value {0} outside of range. Please input an integer between {1} and {2} in {3}".format(val,bounds[0], bounds[1], label))
+					return None
+			if vals == []:
+				IJ.log("No values given for {0}. Please input integers between {1} and {2}.".format(label, bounds[0], bounds[1]))
+				IJ.error("No values given for {0}. Please input integers between {1} and {2}.".format(label, bounds[0], bounds[1]))
+				return None
+			val = vals if swept and isinstance(text, list) else vals[0]
+			lowerVal = out[values[i-1][0]] if upperFinder.match(label) else None #check if label begins with upper
+			if lowerVal is not None and not isinstance(lowerVal, list) and not isinstance(val, list) and val <= lowerVal:#the upper value of any pair of upper and lower values cannot be less than or equal to the lower value
+				sectionLabel = label.split("upper ")[1]
+				IJ.log("Input value outside permitted range. Upper {0} must be greater than lower {0}.".format(sectionLabel))
+				IJ.error("Input value outside permitted range. Upper {0} must be greater than lower {0}.".format(sectionLabel))
+				return None
+			out[label] = val
+		return out
+
+	def parameterList(self, given = None):
+		"""(label, text) pairs of every parameter in dialog order, taking values from given where present and the dialog defaults otherwise"""
+		given = {} if given is None else given
+		IDs = self.idBuilder({})
+		text = lambda value: [str(part) for part in value] if isinstance(value, list) else str(value)
+		return [(pair[0], text(given.get(pair[0], pair[1].getText()))) for item in self.idList for pair in IDs[item][:-1]]
 
 	def cancelPressed(self, event):
 		IJ.error("Parameter selection cancelled. Exiting.")
@@ -117,22 +181,23 @@ class frameMaker():
 	
 	def idBuilder(self, IDs):
 		IDs['channel'] = [("nuclear", JTextField("3", 5)), ("prey", JTextField("2", 5)), ("bait", JTextField("1", 5)), "<html>Input the indices of the indicated channels.</html>"]
-		IDs['nuc'] = [("lower nuclear area", JTextField("4000", 5)), ("upper nuclear area", JTextField("20000", 5)), "<html> <br/>Input the minimum and maximum nuclear area <br/> (in pixels) for nucleus calling.</html>"]
+		IDs['nuc'] = [("lower nuclear area", JTextField("4000", 5)), ("upper nuclear area", JTextField("20000", 5)), ("nucleus downsampling", JTextField("1", 5)), "<html> <br/>Input the minimum and maximum nuclear area <br/> (in pixels) for nucleus calling, and the factor (1 to 8) <br/> by which to bin the nuclear channel to find nuclei faster; <br/> their outlines are then redrawn at full resolution.</html>"]
 		IDs['array'] = [("lower array area", JTextField("5", 5)), ("upper array area", JTextField("200", 5)), "<html> <br/>Input the minimum and maximum array area <br/> (in pixels) for array calling.</html>"]
 		IDs['thresh'] = [("lower threshold", JTextField("97", 5)), ("upper threshold", JTextField("195", 5)), "<html> <br/>Input the values (between 0 and 255) to threshold <br/> the bait images for array calling.</html>"]
+		IDs['tiles'] = [("tile size", JTextField("0", 5)), ("tile overlap", JTextField("200", 5)), "<html> <br/>To process stitched mosaics as tiles input the tile size and <br/> the overlap with neighbouring tiles (in pixels, at least half <br/> the largest nucleus diameter). A tile size of 0 processes <br/> each image whole.</html>"]
+		IDs['workers'] = [("parallel images", JTextField("1", 5)), "<html> <br/>Input the number of images to process at once <br/> (at most the number of processor cores).</html>"]
 		return IDs
 		
 	def dialogBuilder(self, ImageInfo):
 		self.Imageinfo = ImageInfo
+		self.dialog = JDialog()
 		"""set up basic panel with slight border and establish the gb layout"""
 		gb = GridBagLayout()
 		self.panel.setLayout(gb)
 		"""fill the self.IDs hash table of labels and input boxes"""
 		IDs = self.idBuilder({})
-		"""as dictionaries are not ordered in python 2, create separate list of keys to allow looping through self.IDs in the desired order"""
-		idList = ['channel', 'nuc', 'array', 'thresh']
 		"""use idList to loop through self.IDs and add an instruction label and labelled text boxes for each section"""
-		for item in idList:
+		for item in self.idList:
 			temp = IDs[item]
 			instructions = temp.pop()
 			self.sectionLabel(gb, instructions)
@@ -146,139 +211,438 @@ class frameMaker():
 		self.dialog.setModal(True)
 		self.dialog.setVisible(True)
 		return self.out
-		
-def CZIopener(imagefile):
-	"""import czi info incl. image dimensions and series length"""
-	options = ImporterOptions()
-	options.setAutoscale(True)
-	options.setColorMode(ImporterOptions.COLOR_MODE_GRAYSCALE)
-	options.setId(imagefile)
-	imp = BF.openImagePlus(options)[0]
+
+class imageTask(Callable):
+	"""process a single image on a worker thread and checkpoint it in the manifest"""
+	def __init__(self, imagefile, index, total, parameters, outputDir, manifest, cache, profile):
+		self.imagefile = imagefile
+		self.index = index
+		self.total = total
+		self.parameters = parameters
+		self.outputDir = outputDir
+		self.manifest = manifest
+		self.cache = cache
+		self.profile = profile
+		self.log = imageLog()
+
+	def call(self):
+		self.log.log("processing {0}. Image {1} out of {2}".format(self.imagefile, self.index + 1, self.total))
+		with self.profile.time(self.imagefile, "total"):
+			table = imageProcessor(self.imagefile, self.parameters, self.outputDir, self.log, self.cache, self.profile)
+		self.log.log("finished processing {0}. Image {1} out of {2}".format(self.imagefile, self.index + 1, self.total))
+		self.manifest.record(self.imagefile, table, self.log)
+
+class runManifest:
+	"""record of the images already processed with one parameter set, so an interrupted or extended run only processes new images"""
+	def __init__(self, shardDir):
+		self.shardDir = shardDir
+		self.path = shardDir + "manifest.txt"
+		self.lock = threading.Lock()
+		self.entries = {}
+		if File(self.path).exists():
+			with open(self.path) as manifest:
+				for line in manifest:
+					try:
+						entry = json.loads(line)
+					except ValueError: #line cut short by an interrupted run
+						continue
+					self.entries[entry['path']] = entry
+
+	def stamp(self, imagefile):
+		image = File(imagefile)
+		return image.lastModified(), image.length()
+
+	def shardName(self, imagefile):
+		return File(imagefile).getName().split(".")[0] + "_" + hashlib.md5(imagefile.encode("utf-8")).hexdigest()[:8]
+
+	def completed(self, imagefile):
+		entry = self.entries.get(imagefile)
+		return entry is not None and (entry['mtime'], entry['size']) == self.stamp(imagefile)
+
+	def record(self, imagefile, table, log):
+		"""write the shards of a finished image, then add it to the manifest"""
+		name = self.shardName(imagefile)
+		atomicWriter(self.shardDir + name + ".log", log.getText())
+		if table is not None:
+			shardWriter(self.shardDir + name + ".csv", table)
+		mtime, size = self.stamp(imagefile)
+		entry = {'path': imagefile, 'mtime': mtime, 'size': size, 'shard': name, 'measured': table is not None, 'rois': log.roiFile, 'roiEntry': ""}
+		self.write(entry)
+
+	def write(self, entry):
+		with self.lock:
+			with open(self.path, 'a') as manifest:
+				manifest.write(json.dumps(entry) + "\n")
+			self.entries[entry['path']] = entry
+
+	def relocate(self, imagefile, roiFile, roiEntry):
+		"""point a processed image at its rois in roiFile under roiEntry; the later manifest line wins"""
+		entry = dict(self.entries[imagefile])
+		entry['rois'], entry['roiEntry'] = roiFile, roiEntry
+		self.write(entry)
+
+	def log(self, imagefile):
+		"""log of a processed image"""
+		log = imageLog()
+		with open(self.shardDir + self.entries[imagefile]['shard'] + ".log") as logShard:
+			log.lines = logShard.read().decode("utf-8").splitlines()
+		return log
+
+	def roiFile(self, imagefile):
+		"""(zip, entry prefix) holding the rois of a processed image, or None"""
+		entry = self.entries[imagefile]
+		if entry.get('rois') is None or not File(entry['rois']).exists():
+			return None
+		return entry['rois'], entry.get('roiEntry', "")
+
+	def roiFiles(self):
+		"""every zip the manifest points at"""
+		return set(entry['rois'] for entry in self.entries.values() if entry.get('rois') is not None)
+
+	def rows(self, imagefile):
+		"""measurement rows of a processed image, read lazily from its shard"""
+		entry = self.entries[imagefile]
+		if not entry['measured']:
+			return []
+		return shardReader(self.shardDir + entry['shard'] + ".csv")
+
+class roiArchive:
+	"""the rois of all images of a run in one zip, each image's under "<image name>/", written through a temporary file by close()"""
+	def __init__(self, filepath):
+		self.filepath = filepath
+		self.temp = filepath[:-len(".zip")] + ".part.zip"
+		self.names = set()
+		self.stream = None
+
+	def add(self, name, roiFile, prefix = ""):
+		"""copy the entries of roiFile starting with prefix under name, or name-2, name-3... if taken; returns the new prefix"""
+		if name in self.names:
+			level = 2
+			while "{0}-{1}".format(name, level) in self.names:
+				level += 1
+			name = "{0}-{1}".format(name, level)
+		self.names.add(name)
+		if self.stream is None:
+			self.stream = ZipOutputStream(BufferedOutputStream(FileOutputStream(self.temp)))
+		archive = ZipFile(roiFile)
+		try:
+			buffer = zeros(8192, 'b')
+			for entry in Collections.list(archive.entries()):
+				if not entry.getName().startswith(prefix):
+					continue
+				self.stream.putNextEntry(ZipEntry(name + "/" + entry.getName()[len(prefix):]))
+				source = archive.getInputStream(entry)
+				length = source.read(buffer)
+				while length > 0:
+					self.stream.write(buffer, 0, length)
+					length = source.read(buffer)
+				source.close()
+				self.stream.closeEntry()
+		finally:
+			archive.close()
+		return name + "/"
+
+	def close(self):
+		"""path of the finished zip, or None if no image had rois"""
+		if self.stream is None:
+			return None
+		self.stream.close()
+		atomicMove(self.temp, self.filepath)
+		return self.filepath
+
+	def abort(self):
+		if self.stream is not None:
+			self.stream.close()
+			File(self.temp).delete()
+
+class sweepTask(Callable):
+	"""run the parameter sweep of a single image on a worker thread; returns its rows of the sweep table"""
+	def __init__(self, imagefile, index, total, grid, cache, profile):
+		self.imagefile = imagefile
+		self.index = index
+		self.total = total
+		self.grid = grid
+		self.cache = cache
+		self.profile = profile
+		self.log = imageLog()
+
+	def call(self):
+		self.log.log("sweeping {0} parameter sets over {1}. Image {2} out of {3}".format(len(self.grid), self.imagefile, self.index + 1, self.total))
+		with self.profile.time(self.imagefile, "total"):
+			table = sweepProcessor(self.imagefile, self.grid, self.log, self.cache, self.profile)
+		self.log.log("finished sweeping {0}. Image {1} out of {2}".format(self.imagefile, self.index + 1, self.total))
+		return table
+
+class tileTask(Callable):
+	"""call, filter, pair and measure the nuclei and arrays of one tile of a stitched mosaic; rois are returned in region coordinates"""
+	def __init__(self, imagefile, core, region, channels, slices, parameters, levels, imageLabels, profile):
+		self.imagefile = imagefile
+		self.profile = profile
+		self.core = core
+		self.region = region
+		self.channels = channels
+		self.slices = slices
+		self.parameters = parameters
+		self.levels = levels
+		self.imageLabels = imageLabels
+
+	def call(self):
+		with self.profile.time(self.imagefile, "open"):
+			czi = cziAccess(self.imagefile, True)
+			try:
+				imp = czi.openImage(0, self.channels, self.region)
+			finally:
+				czi.close()
+		pairs = tilePairs(imp, self.core, self.region, self.slices, self.parameters, self.levels, self.profile, self.imagefile)
+		with self.profile.time(self.imagefile, "measureImage") as timer:
+			table = measureImage(imp, pairs, self.slices, self.imageLabels) if Overlay.size(pairs) > 0 else []
+			timer.count = len(table)
+		imp.flush()
+		return pairs, table
+
+def atomicWriter(filepath, text):
+	"""write text through a temporary file, so an interrupted run never leaves a partly written file"""
+	temp = filepath + ".part"
+	with open(temp, 'w') as textFile:
+		textFile.write(text.encode("utf-8"))
+	atomicMove(temp, filepath)
+
+def blurRadius(ip, sigma):
+	"""radius in pixels of the kernel GaussianBlur.blurGaussian uses for ip, at the accuracy it picks for ip's type"""
+	accuracy = 0.002 if isinstance(ip, (ByteProcessor, ColorProcessor)) else 0.0002
+	return int(math.ceil(sigma * math.sqrt(-2 * math.log(accuracy)))) + 1
+
+def CZIopener(imagefile, channels = None):
+	"""open the given channels (by default all) of the first series of the czi file"""
+	czi = cziAccess(imagefile)
+	imp = czi.openImage(0, channels)
+	czi.close()
 	return imp
 
-def findnucleus(imp, parameters):
-	"""call nuclei"""
-	IJ.run(imp, "Gaussian Blur...", "sigma=3")
-	IJ.run(imp, "Enhance Contrast", "saturated=0.35")
-	IJ.run(imp, "Apply LUT", "")
-	IJ.run(imp, "Auto Threshold", "method=Default white")
-	IJ.run(imp, "Make Binary", "BlackBackground")
-	IJ.run(imp, "Analyze Particles...", "size=" + str(parameters['lower nuclear area']) + "-" + str(parameters['upper nuclear area']) + " circularity=0.50-1.00 show=Overlay include")
-	DAPIoverlay = imp.getOverlay()
+def cutNuclei(ip, cut, parameters):
+	"""nuclei of a nuclear plane (or a crop of it), blurred in place and cut at the fixed blurred intensity cut"""
+	GaussianBlur().blurGaussian(ip, nucleusSigma)
+	ip.setThreshold(math.ceil(cut), ip.maxValue(), ImageProcessor.NO_LUT_UPDATE)
+	mask = ip.createMask()
+	mask.setThreshold(255, 255, ImageProcessor.NO_LUT_UPDATE)
+	return analyzeParticles(ImagePlus("nucleus", mask), parameters['lower nuclear area'], parameters['upper nuclear area'], 0.5)
+
+def findnucleus(imp, parameters, native = True):
+	"""call nuclei, on a binned copy of imp if a nucleus downsampling factor is set"""
+	factor = parameters.get('nucleus downsampling', 1)
+	if factor > 1:
+		return findnucleusDownsampled(imp, parameters, factor)
+	nucleusMask(imp, nucleusSigma, native)
+	DAPIoverlay = analyzeParticles(imp, parameters['lower nuclear area'], parameters['upper nuclear area'], 0.5)
 	return DAPIoverlay
 
-def findarray(images, DAPIoverlay, totalnuclei, parameters):
+def findnucleusDownsampled(imp, parameters, factor):
+	"""call nuclei on a copy of imp binned by factor, then redraw each at full resolution. imp is not changed"""
+	ip = imp.getProcessor()
+	small = ImagePlus("nuclear", Binner().shrink(ip, factor, factor, Binner.AVERAGE))
+	cut = nucleusCut(small, factor)
+	if cut is None:
+		return None
+	coarse = analyzeParticles(small, parameters['lower nuclear area'] / (2.0 * factor * factor), 2.0 * parameters['upper nuclear area'] / (factor * factor), 0.0)
+	if not coarse:
+		return None
+	imageBounds = Rectangle(imp.getWidth(), imp.getHeight())
+	#a crop reaches as far as the blur around the coarse outline, which may lie a binned pixel off on either side
+	margin = blurRadius(ip, nucleusSigma) + 2 * factor
+	refined = []
+	for i in range(Overlay.size(coarse)):
+		outline = RoiScaler.scale(coarse.get(i), factor, factor, False)
+		box = outline.getBounds()
+		box.grow(margin, margin)
+		box = box.intersection(imageBounds)
+		ip.setRoi(box)
+		region = ip.crop()
+		ip.resetRoi()
+		particles = cutNuclei(region, cut, parameters)
+		for roi in (particles if particles else []):
+			x, y = roi.getContourCentroid()
+			if outline.contains(int(x) + box.x, int(y) + box.y):
+				roi.setLocation(roi.getXBase() + box.x, roi.getYBase() + box.y)
+				refined.append(roi)
+	if refined == []:
+		return None
+	#in the order the particle analyzer finds them in the whole image, on which nucFilter's skipping depends
+	refined.sort(key = scanStart)
+	DAPIoverlay = Overlay()
+	for roi in refined:
+		DAPIoverlay.add(roi)
+	return DAPIoverlay
+
+def findarray(images, DAPIoverlay, totalnuclei, parameters, method = "label", displayRange = None):
 	"""use the nuclear channel to make a mask of all non-nuclear areas in the image, then identify the arrays"""
-	nucShape = ShapeRoi(DAPIoverlay.get(0))
-	i = 1
-	while i < totalnuclei:
-		shape = ShapeRoi(DAPIoverlay.get(i))
-		nucShape = nucShape.or(shape)
-		i += 1
-	bgShape = ShapeRoi(Roi(0, 0, images['bait'].getWidth(), images['bait'].getHeight()))
-	bgShape = bgShape.not(nucShape)
 	ip = images['bait'].getProcessor()
 	ip.setValue(0)
-	ip.setRoi(bgShape)
-	ip.fill(ip.getMask())
-	IJ.run(images['bait'], "8-bit", "")
+	if method == "shape":
+		nucShape = ShapeRoi(DAPIoverlay.get(0))
+		i = 1
+		while i < totalnuclei:
+			shape = ShapeRoi(DAPIoverlay.get(i))
+			nucShape = nucShape.or(shape)
+			i += 1
+		bgShape = ShapeRoi(Roi(0, 0, images['bait'].getWidth(), images['bait'].getHeight()))
+		bgShape = bgShape.not(nucShape)
+		ip.setRoi(bgShape)
+		ip.fill(ip.getMask())
+	else:
+		labels = labelImage(DAPIoverlay, images['bait'].getWidth(), images['bait'].getHeight())
+		ip.resetRoi()
+		ip.fill(backgroundMask(labels))
+	if displayRange is not None:
+		images['bait'].setDisplayRange(displayRange[0], displayRange[1])
+	ImageConverter(images['bait']).convertToGray8()
 	IJ.setThreshold(images['bait'], parameters['lower threshold'], parameters['upper threshold'], "Black & White")
-	IJ.run(images['bait'], "Analyze Particles...", "size=" + str(parameters['lower array area']) + "-" + str(parameters['upper array area']) + "pixel circularity=0.50-1.00 show=Overlay include")
-	baitoverlay = images['bait'].getOverlay()
+	baitoverlay = analyzeParticles(images['bait'], parameters['lower array area'], parameters['upper array area'], 0.5)
 	return baitoverlay
 
-def getCZIinfo(imagefile):
-	"""import czi info incl. image dimensions and series length"""
-	CZIinfo = {}
-	options = DynamicMetadataOptions()
-	options.setBoolean("zeissczi.autostitch", False)
-	options.setBoolean("zeissczi.attachments", False)
-	czireader = ZeissCZIReader()
-	czireader.setFlattenedResolutions(False)
-	czireader.setMetadataOptions(options)
-	czireader.setId(imagefile)
-	CZIinfo['seriesCount'] = czireader.getSeriesCount()
-	CZIinfo['SizeC'] = czireader.getSizeC()
-	CZIinfo['SizeX'] = czireader.getSizeX()
-	CZIinfo['SizeY'] = czireader.getSizeY()
-	czireader.close()
-	return CZIinfo
-
-def imageProcessor(imagefile, parameters, outputDir):
-	imp = CZIopener(imagefile)
+def imageProcessor(imagefile, parameters, outputDir, log, cache = None, profile = None):
+	"""read, call, pair and measure the nuclei and arrays of one czi image, caching and timing each stage"""
+	cache = resultCache(None, 0) if cache is None else cache
+	profile = stageProfile() if profile is None else profile
+	channels = sorted(set([parameters[label] for label in ["nuclear", "bait", "prey"]]))
+	slices = dict((label, channels.index(parameters[label]) + 1) for label in ["nuclear", "bait", "prey"])
 	images, imageLabels = {}, {}
-	imageLabels['snapName'] = imp.getTitle().split(".")[0]
+	imageLabels['snapName'] = File(imagefile).getName().split(".")[0]
 	imageLabels['imagefile'] = imagefile
 	imageLabels['date'] = SimpleDateFormat("yyyy/MM/dd").format(File(imagefile).lastModified())
-	IJ.log("processing {0}".format(imageLabels['snapName']))
-	images['nuclear'] = ImagePlus('nuclear', imp.getImageStack().getProcessor(parameters["nuclear"])).duplicate()
-	images['bait'] = ImagePlus('bait', imp.getImageStack().getProcessor(parameters["bait"])).duplicate()
+	log.log("processing {0}".format(imageLabels['snapName']))
+	if parameters['tile size'] > 0:
+		return tileProcessor(imagefile, parameters, outputDir, log, channels, slices, imageLabels, profile)
+	with profile.time(imagefile, "open"):
+		fileHash = cache.fileHash(imagefile)
+		imp = cache.image(cache.key(fileHash, channels), lambda: CZIopener(imagefile, channels))
+	images['nuclear'] = ImagePlus('nuclear', imp.getImageStack().getProcessor(slices["nuclear"])).duplicate()
+	images['bait'] = ImagePlus('bait', imp.getImageStack().getProcessor(slices["bait"])).duplicate()
 	"""use the DAPI channel to call nuclei"""
-	DAPIoverlay = findnucleus(images['nuclear'], parameters)
+	nucleiKey = cache.key(fileHash, parameters['nuclear'], parameters['lower nuclear area'], parameters['upper nuclear area'], parameters['nucleus downsampling'])
+	with profile.time(imagefile, "findnucleus") as timer:
+		DAPIoverlay = cache.rois(nucleiKey, lambda: findnucleus(images['nuclear'], parameters))
+		timer.count = Overlay.size(DAPIoverlay) if DAPIoverlay else 0
 	if not DAPIoverlay:
-		IJ.log("no nuclei called in {0}".format(imageLabels['snapName']))
+		log.log("no nuclei called in {0}".format(imageLabels['snapName']))
 		return None
 	totalnuclei = Overlay.size(DAPIoverlay)
-	IJ.log("{0} nuclei found in {1}".format(totalnuclei, imageLabels['snapName']))
-	baitoverlay = findarray(images, DAPIoverlay, totalnuclei, parameters)
+	log.log("{0} nuclei found in {1}".format(totalnuclei, imageLabels['snapName']))
+	arrayKey = cache.key(nucleiKey, parameters['bait'], parameters['lower array area'], parameters['upper array area'], parameters['lower threshold'], parameters['upper threshold'])
+	with profile.time(imagefile, "findarray") as timer:
+		baitoverlay = cache.rois(arrayKey, lambda: findarray(images, DAPIoverlay, totalnuclei, parameters))
+		timer.count = Overlay.size(baitoverlay) if baitoverlay else 0
 	if not baitoverlay:
-		IJ.log("no arrays coincident with called nuclei in {0}".format(imageLabels['snapName']))
+		log.log("no arrays coincident with called nuclei in {0}".format(imageLabels['snapName']))
 		return None
 	totalarray = Overlay.size(baitoverlay)
-	IJ.log("{0} array(s) found in {1}".format(totalarray, imageLabels['snapName']))
-	DAPIoverlay, totalnuclei = nucFilter(DAPIoverlay, baitoverlay, totalarray, totalnuclei)
-	finalOverlay = nucArraypairer(DAPIoverlay,baitoverlay, totalarray, totalnuclei)
+	log.log("{0} array(s) found in {1}".format(totalarray, imageLabels['snapName']))
+	with profile.time(imagefile, "nucFilter") as timer:
+		DAPIoverlay, totalnuclei = nucFilter(DAPIoverlay, baitoverlay, totalarray, totalnuclei)
+		timer.count = totalnuclei
+	with profile.time(imagefile, "nucArraypairer") as timer:
+		finalOverlay = nucArraypairer(DAPIoverlay,baitoverlay, totalarray, totalnuclei)
+		timer.count = Overlay.size(finalOverlay) // 3
 	if Overlay.size(finalOverlay) == 0:
-		IJ.log("no single coincident arrays and nuclei identified in snap {0}".format(imageLabels['snapName']))
+		log.log("no single coincident arrays and nuclei identified in snap {0}".format(imageLabels['snapName']))
 		return None
-	table = measureImage(imp, finalOverlay, parameters, imageLabels)
+	with profile.time(imagefile, "measureImage") as timer:
+		table = measureImage(imp, finalOverlay, slices, imageLabels)
+		timer.count = len(table)
 	if len(table) > 0:
 		"""save rois to output directory so can check success of array/nucleus caller and see which specific arrays & nuclei were identified"""
-		roiSaver(finalOverlay, outputDir, imageLabels['snapName'])
+		with profile.time(imagefile, "roiSaver") as timer:
+			roiSaver(finalOverlay, outputDir, imageLabels['snapName'], log)
+			timer.count = Overlay.size(finalOverlay)
 		return table
 	else:
-		IJ.log("table not generated for {0} even though transfected cells overlapped specific nuclei.".format(imageLabels['snapName']))
+		log.log("table not generated for {0} even though transfected cells overlapped specific nuclei.".format(imageLabels['snapName']))
 		return None
 
-def measureImage(imp, overlay, parameters, imageLabels):
-	overlaySize = Overlay.size(overlay)
+def measureImage(imp, overlay, slices, imageLabels):
 	imp.setOverlay(overlay)
 	table = []
-	channels = {"prey":parameters["prey"], "bait": parameters["bait"]}
-	for label, channel in channels.items():
-		imp.setSlice(channel)
-		temp = []
-		for i in range(overlaySize):
-			roi = overlay.get(i)
-			roi.setImage(imp)
-			roi.setPosition(imp)
-			Rname = Roi.getName(roi)
-			roiStat = roi.getStatistics()
-			temp.append(imageLabels['imagefile'])
-			temp.append(imageLabels['date'])
-			temp.append(imageLabels['snapName'])
-			temp.append(label)
-			temp.append(Rname)
-			temp.append(roiStat.area)
-			temp.append(roiStat.mean)
-			temp.append(roiStat.median)
-		table.append(temp)
+	channels = {"prey":slices["prey"], "bait": slices["bait"]}
+	for label, i, roiStat in roiStatistics(imp, overlay, channels.items()):
+		Rname = Roi.getName(overlay.get(i))
+		table.append([imageLabels['imagefile'], imageLabels['date'], imageLabels['snapName'], label, Rname, roiStat.area, roiStat.mean, roiStat.median])
 	return table
 
+def mosaicLevels(cores, opener, mosaic, slices):
+	"""nucleus cut and bait display range of a whole mosaic, read core by core with opener(core); None if it holds no nucleus"""
+	factor = 1
+	while max(mosaic.width, mosaic.height) > 4096 * factor:
+		factor *= 2
+	overview = ShortProcessor(mosaic.width // factor, mosaic.height // factor)
+	lowest, highest = None, None
+	for core in cores:
+		imp = opener(core)
+		stack = imp.getImageStack()
+		overview.insert(Binner().shrink(stack.getProcessor(slices['nuclear']), factor, factor, Binner.AVERAGE), core.x // factor, core.y // factor)
+		stats = IS.getStatistics(stack.getProcessor(slices['bait']), IS.MIN_MAX, None)
+		lowest = stats.min if lowest is None else min(lowest, stats.min)
+		highest = stats.max if highest is None else max(highest, stats.max)
+		imp.flush()
+	cut = nucleusCut(ImagePlus("overview", overview), factor)
+	if cut is None:
+		return None
+	return {'nuclear cut': cut, 'bait range': (lowest, highest)}
+
+def nucleusCut(small, factor):
+	"""cut between nucleus and background in blurred intensity, from small, the nuclear plane binned by factor; None if it holds no nucleus"""
+	GaussianBlur().blurGaussian(small.getProcessor(), float(nucleusSigma) / factor)
+	blurred = small.getProcessor().duplicate()
+	nucleusMask(small, 0)
+	mask = small.getProcessor()
+	blurred.setRoi(Rectangle(blurred.getWidth(), blurred.getHeight()))
+	blurred.setMask(mask)
+	nucleus = IS.getStatistics(blurred, IS.MIN_MAX | IS.AREA, None)
+	background = mask.duplicate()
+	background.invert()
+	blurred.setMask(background)
+	outside = IS.getStatistics(blurred, IS.MIN_MAX | IS.AREA, None)
+	if nucleus.pixelCount == 0:
+		return None
+	return nucleus.min if outside.pixelCount == 0 else (nucleus.min + outside.max) / 2.0
+
+def nucleusMask(imp, sigma, native = True):
+	"""blur, stretch the contrast, threshold and make binary, in place; native = False runs the original command chain"""
+	if native:
+		if sigma > 0:
+			GaussianBlur().blurGaussian(imp.getProcessor(), sigma)
+		ContrastEnhancer().stretchHistogram(imp, 0.35)
+		applier = LutApplier()
+		applier.setup("", imp)
+		applier.run(imp.getProcessor())
+		Auto_Threshold().exec(imp, "Default", False, False, True, False, False, False)
+		#nuclei are the non zero pixels of the thresholded image; the threshold on the mask makes them the particles
+		#whatever the black background setting
+		ip = imp.getProcessor()
+		ip.setThreshold(1, ip.maxValue(), ImageProcessor.NO_LUT_UPDATE)
+		mask = ip.createMask()
+		mask.setThreshold(255, 255, ImageProcessor.NO_LUT_UPDATE)
+		imp.setProcessor(mask)
+	else:
+		if sigma > 0:
+			IJ.run(imp, "Gaussian Blur...", "sigma={0}".format(sigma))
+		IJ.run(imp, "Enhance Contrast", "saturated=0.35")
+		IJ.run(imp, "Apply LUT", "")
+		IJ.run(imp, "Auto Threshold", "method=Default white")
+		IJ.run(imp, "Make Binary", "BlackBackground")
+
 def nucArraypairer(DAPIoverlay, baitoverlay, totalarray, totalnuclei):
+	"""pair each nucleus with the first remaining array it overlaps"""
 	finalOverlay = Overlay()
-	j = list(range(totalarray))
+	arrayMasks = [roiMask(baitoverlay.get(k)) for k in range(totalarray)]
+	arrayIndex = roiIndex(arrayMasks)
+	j = set(range(totalarray))
 	for i in range(totalnuclei):
 		tempNo = str(i + 1)
 		roi = DAPIoverlay.get(i)
-		nucPoints = roi.getContainedPoints()
-		breakVal = 0
-		for k, element in enumerate(j):
-			roi2 = baitoverlay.get(element)
-			arrayPoints = roi2.getContainedPoints()
-			overlapTest = bool(set(arrayPoints) & set(nucPoints))
-			if overlapTest == False:
+		nucMask = roiMask(roi)
+		for element in arrayIndex.candidates(nucMask[0]):
+			if element not in j or overlapArea(nucMask, arrayMasks[element]) == 0:
 				continue
+			roi2 = baitoverlay.get(element)
 			nucleoplasm = ShapeRoi(roi).not(ShapeRoi(roi2))
 			Roi.setName(roi, "nucleus_" + tempNo)
 			Roi.setName(roi2, "array_" + tempNo)
@@ -292,19 +656,23 @@ def nucArraypairer(DAPIoverlay, baitoverlay, totalarray, totalnuclei):
 
 def nucFilter(DAPIoverlay, baitoverlay, totalarray, totalnuclei):
 	"""remove all nuclei that do not contain precisely one array from DAPIoverlay"""
-	completed = []
+	arrayMasks = [roiMask(baitoverlay.get(k)) for k in range(totalarray)]
+	arrayIndex = roiIndex(arrayMasks)
 	j = list(range(totalarray))
 	i = 0
 	while i < totalnuclei:
 		roi = DAPIoverlay.get(i)
-		nucPoints = roi.getContainedPoints()
+		nucMask = roiMask(roi)
 		overlapCounter = 0
-		for k, element in enumerate(j):
-			roi2 = baitoverlay.get(element)
-			arrayPoints = roi2.getContainedPoints()
-			overlapTest = bool(set(arrayPoints) & set(nucPoints))
-			if overlapTest == True:
-				j.remove(element)
+		skipped = None
+		for element in arrayIndex.candidates(nucMask[0]):
+			position = bisect.bisect_left(j, element)
+			if position == len(j) or j[position] != element or element == skipped:
+				continue
+			if overlapArea(nucMask, arrayMasks[element]) > 0:
+				"""arrays used to be removed from j while looping over it, skipping the next array; keep skipping it so nuclei are filtered as before"""
+				j.pop(position)
+				skipped = j[position] if position < len(j) else None
 				overlapCounter += 1
 		if overlapCounter != 1:
 			DAPIoverlay.remove(roi)
@@ -313,7 +681,54 @@ def nucFilter(DAPIoverlay, baitoverlay, totalarray, totalnuclei):
 			i += 1
 	return DAPIoverlay, totalnuclei
 
-def processDirectory(inputDir):
+def parameterKey(parameters):
+	"""short hash of the parameters that affect the measurements, naming the shard directory of a parameter set"""
+	relevant = sorted((key, value) for key, value in parameters.items() if key != "parallel images")
+	return hashlib.md5(json.dumps(relevant)).hexdigest()[:12]
+
+def parameterReader(parameterFile):
+	"""read the parameters for an unattended run from a .json or .properties file keyed by the dialog labels"""
+	path = parameterFile.getAbsolutePath()
+	try:
+		if path.endswith(".json"):
+			with open(path) as parameterStream:
+				given = json.load(parameterStream)
+		else:
+			properties = Properties()
+			parameterStream = FileInputStream(path)
+			properties.load(parameterStream)
+			parameterStream.close()
+			given = dict((key, properties.getProperty(key)) for key in properties.stringPropertyNames())
+	except Exception, e:
+		IJ.log("Unable to read parameter file {0}: {1}. Exiting".format(path, e))
+		IJ.error("Unable to read parameter file {0}: {1}. Exiting".format(path, e))
+		return None
+	given = dict((str(key).replace("_", " "), value) for key, value in given.items())
+	known = [label for label, text in frameMaker().parameterList()] + ['input directories']
+	for key in given:
+		if key not in known:
+			IJ.log("Ignoring unknown parameter {0} in {1}".format(key, path))
+	if 'input directories' in given and isinstance(given['input directories'], basestring):
+		given['input directories'] = [directory.strip() for directory in given['input directories'].split(",")]
+	return given
+
+def processDirectory(inputDir, parameterFile = None, cacheDir = None, cacheLimit = 20, showResults = False, collectRois = False):
+	"""process all czi files in inputDir, with parameters from the dialog or from parameterFile"""
+	given = None
+	if parameterFile is not None:
+		given = parameterReader(parameterFile)
+		if given is None:
+			return
+		if 'input directories' in given:
+			inputDir = [File(directory) for directory in given.pop('input directories')]
+	elif GraphicsEnvironment.isHeadless():
+		IJ.log("A parameter file is required to run without a display. Exiting")
+		IJ.error("A parameter file is required to run without a display. Exiting")
+		return
+	if not inputDir:
+		IJ.log("No input directories selected. Exiting")
+		IJ.error("No input directories selected. Exiting")
+		return
 	sep = System.getProperty("file.separator")
 	outputDir = inputDir[0].getParent() + sep + "output" + sep
 	cziFinder = re.compile(".*czi$")
@@ -329,78 +744,311 @@ def processDirectory(inputDir):
 		IJ.log("F2H processing requires a minimum of 2 channels. Exiting")
 		IJ.error("F2H processing requires a minimum of 2 channels. Exiting")
 		return
-	else:
+	elif given is None:
 		parameters = frameMaker().dialogBuilder(CZIinfo)
 		if parameters == {}:
 			return
-		for key, value in parameters.items():
-			print "{0}: {1}".format(key, value)
+	else:
+		validator = frameMaker()
+		validator.Imageinfo = CZIinfo
+		grid = sweepGrid(given, validator)
+		if grid is None:
+			return
+		if len(grid) > 1:
+			processSweep(pathList, grid, outputDir, resultCache(cacheDir.getAbsolutePath() if cacheDir else None, cacheLimit * 1024 ** 3))
+			return
+		parameters = grid[0]
+	for key, value in parameters.items():
+		print "{0}: {1}".format(key, value)
+	runLog = imageLog()
 	if File(outputDir).exists() == False:
 		File(outputDir).mkdir()
-		IJ.log("Output directory created at {0}".format(outputDir))
+		runLog.log("Output directory created at {0}".format(outputDir))
 	else:
-		IJ.log("Output directory exists at {0}".format(outputDir))
-	outputArray = []
-	for i, image in enumerate(pathList):
-		IJ.log("processing {0}. Image {1} out of {2}".format(image, i + 1, pathLen))
-		outputArray.append(imageProcessor(image, parameters, outputDir))
-		IJ.log("finished processing {0}. Image {1} out of {2}".format(image, i + 1, pathLen))
-	IJ.log("image processing finished")
-	log = IJ.getLog()
-	resultsSaver(log, outputDir, "F2H_log", ".txt")
-	table = resultsTablemaker(outputArray)
-	if ResultsTable.size(table) == 0:
+		runLog.log("Output directory exists at {0}".format(outputDir))
+	"""process the images not yet in the manifest on the worker pool, then collect all results and logs in input order"""
+	shardDir = outputDir + "shards" + sep + parameterKey(parameters) + sep
+	File(shardDir).mkdirs()
+	manifest = runManifest(shardDir)
+	pending = [(i, image) for i, image in enumerate(pathList) if not manifest.completed(image)]
+	if len(pending) < pathLen:
+		runLog.log("{0} of {1} images already processed with these parameters in {2}".format(pathLen - len(pending), pathLen, shardDir))
+	cache = resultCache(cacheDir.getAbsolutePath() if cacheDir else None, cacheLimit * 1024 ** 3)
+	profile = stageProfile()
+	tasks = [imageTask(image, i, pathLen, parameters, outputDir, manifest, cache, profile) for i, image in pending]
+	#in tile mode the tiles of each image are processed in parallel instead of the images
+	pool = Executors.newFixedThreadPool(1 if parameters['tile size'] > 0 else parameters['parallel images'])
+	results = resultsWriter(uniquePath(outputDir, "F2H_results", ".csv"), resultColumns)
+	archive = roiArchive(uniquePath(outputDir, "F2H_rois", ".zip")) if collectRois else None
+	archived = []
+	try:
+		futures = dict((task.imagefile, (task, pool.submit(task))) for task in tasks)
+		for image in pathList:
+			if image in futures:
+				task, future = futures[image]
+				future.get()
+				runLog.extend(task.log)
+			else:
+				runLog.extend(manifest.log(image))
+			results.write(manifest.rows(image))
+			if archive is not None and manifest.roiFile(image) is not None:
+				roiFile, prefix = manifest.roiFile(image)
+				archived.append((image, roiFile, archive.add(File(image).getName().split(".")[0], roiFile, prefix)))
+	except:
+		results.abort()
+		if archive is not None:
+			archive.abort()
+		raise
+	finally:
+		pool.shutdown()
+	runLog.log("image processing finished")
+	if archive is not None:
+		archivePath = archive.close()
+		if archivePath is not None:
+			#the archive replaces the zips it was copied from: the manifest points at it first, then the zips no image refers to are deleted
+			for image, roiFile, entry in archived:
+				manifest.relocate(image, archivePath, entry)
+			for roiFile in set(roiFile for image, roiFile, entry in archived) - manifest.roiFiles():
+				File(roiFile).delete()
+			runLog.log("rois of all images collected in {0}".format(archivePath))
+	if tasks:
+		for line in profile.summary():
+			runLog.log(line)
+		runLog.log("stage timings saved to {0}".format(profile.save(uniquePath(outputDir, "F2H_profile", ".csv"))))
+	resultsSaver(runLog.getText(), outputDir, "F2H_log", ".txt")
+	resultsPath = results.close()
+	if resultsPath is None:
 		IJ.log("No transfected cells found. Bye.")
 		return
-	resultsSaver(table, outputDir, "F2H_results", ".csv")
+	IJ.log("Output saved to {0}".format(resultsPath))
 	WindowManager.closeAllWindows()
+	if showResults and not GraphicsEnvironment.isHeadless():
+		ResultsTable.open(resultsPath).show("F2H_results")
+
+def processSweep(pathList, grid, outputDir, cache):
+	"""measure every image with every parameter set of grid into one F2H_sweep csv"""
+	runLog = imageLog()
+	File(outputDir).mkdirs()
+	parameters = grid[0]
+	if parameters['tile size'] > 0:
+		IJ.log("Parameter sweeps are not run in tile mode. Exiting")
+		IJ.error("Parameter sweeps are not run in tile mode. Exiting")
+		return
+	runLog.log("sweeping {0} parameter sets over {1} images".format(len(grid), len(pathList)))
+	for label in sweepLabels:
+		runLog.log("{0}: {1}".format(label, ", ".join(str(value) for value in sorted(set(point[label] for point in grid)))))
+	profile = stageProfile()
+	tasks = [sweepTask(image, i, len(pathList), grid, cache, profile) for i, image in enumerate(pathList)]
+	pool = Executors.newFixedThreadPool(parameters['parallel images'])
+	results = resultsWriter(uniquePath(outputDir, "F2H_sweep", ".csv"), sweepLabels + resultColumns)
+	try:
+		futures = [(task, pool.submit(task)) for task in tasks]
+		for task, future in futures:
+			results.write(future.get())
+			runLog.extend(task.log)
+	except:
+		results.abort()
+		raise
+	finally:
+		pool.shutdown()
+	runLog.log("parameter sweep finished")
+	for line in profile.summary():
+		runLog.log(line)
+	runLog.log("stage timings saved to {0}".format(profile.save(uniquePath(outputDir, "F2H_profile", ".csv"))))
+	resultsSaver(runLog.getText(), outputDir, "F2H_log", ".txt")
+	resultsPath = results.close()
+	if resultsPath is None:
+		IJ.log("No transfected cells found with any parameter set. Bye.")
+		return
+	IJ.log("Output saved to {0}".format(resultsPath))
+
+def roiSaver(overlay, output, name, log):
+	"""save the rois of overlay as name_rois.zip in output and keep its path in log.roiFile"""
+	filepath = uniquePath(output, name + "_rois", ".zip")
+	temp = filepath[:-len(".zip")] + ".part.zip"
+	roiZipWriter(overlay, temp)
+	atomicMove(temp, filepath)
+	log.roiFile = filepath
+	log.log("Output saved to {0}".format(filepath))
+
+def scanStart(roi):
+	"""(y, x) of the first pixel of roi in raster order, where the particle analyzer finds the particle"""
+	bounds = roi.getBounds()
+	mask = roi.getMask()
+	first = 0 if mask is None else next((x for x in range(bounds.width) if mask.get(x, 0) != 0), 0)
+	return bounds.y, bounds.x + first
+
+def shardReader(filepath):
+	"""yield the measurement rows of one image from its shard, in the form returned by measureImage"""
+	with open(filepath, 'rb') as shard:
+		rows = csv.reader(shard)
+		next(rows)
+		for row in rows:
+			yield [value.decode("utf-8") for value in row[:5]] + [float(value) for value in row[5:]]
+
+def shardWriter(filepath, table):
+	"""write the measurement rows of one image as csv through a temporary file"""
+	temp = filepath + ".part"
+	with open(temp, 'wb') as shard:
+		writer = csv.writer(shard)
+		writer.writerow(resultColumns)
+		for row in table:
+			writer.writerow([repr(value) if isinstance(value, float) else unicode(value).encode("utf-8") for value in row])
+	atomicMove(temp, filepath)
+
+def sweepGrid(given, validator):
+	"""parameter sets of a sweep, every combination of the values given as lists; None after reporting an invalid value"""
+	values = validator.validate(validator.parameterList(given), True)
+	if values is None:
+		return None
+	swept = [[(label, value) for value in values[label]] for label in sweepLabels if isinstance(values[label], list)]
+	grid = []
+	for combination in itertools.product(*swept):
+		point = dict(values)
+		point.update(dict(combination))
+		if any(point["upper " + name] <= point["lower " + name] for name in ["nuclear area", "array area", "threshold"]):
+			continue
+		parameters = validator.validate(validator.parameterList(point))
+		if parameters is None:
+			return None
+		grid.append(parameters)
+	if grid == []:
+		IJ.log("No parameter set of the sweep has its upper bounds above its lower bounds. Exiting")
+		IJ.error("No parameter set of the sweep has its upper bounds above its lower bounds. Exiting")
+		return None
+	return grid
 
-def resultsSaver(item, output, name, extension):
-	"""save results table and log files"""
-	filepath = output + name + extension
-	level = 0
-	while File(filepath).exists():
-		level += 1
-		filepath = output + name + str(level) + extension
-	if extension == ".csv":
-		item.save(filepath)
-	elif extension == ".txt":
-		with open(filepath, 'w') as logSaver:
-			logSaver.write(item)
-	elif extension == ".zip":
-		rm = RoiManager.getInstance()
-		rm.runCommand("save selected", filepath)
-	IJ.log("Output saved to {0}".format(filepath))
-
-def resultsTablemaker(outputArray):
-	"""fill results table"""
-	IJ.log("filling results table")
-	table = ResultsTable()
-	colnames = collections.deque(["Path", "Date", "Name", "Channel", "ROI", "Area", "Mean", "Median"])
-	colLen = len(colnames)
-	for image in outputArray:
-		if image is None:
+def sweepProcessor(imagefile, grid, log, cache = None, profile = None):
+	"""imageProcessor for a parameter sweep; returns the rows of all parameter sets, each led by its sweepLabels values"""
+	cache = resultCache(None, 0) if cache is None else cache
+	profile = stageProfile() if profile is None else profile
+	channels = sorted(set([grid[0][label] for label in ["nuclear", "bait", "prey"]]))
+	slices = dict((label, channels.index(grid[0][label]) + 1) for label in ["nuclear", "bait", "prey"])
+	imageLabels = {}
+	imageLabels['snapName'] = File(imagefile).getName().split(".")[0]
+	imageLabels['imagefile'] = imagefile
+	imageLabels['date'] = SimpleDateFormat("yyyy/MM/dd").format(File(imagefile).lastModified())
+	with profile.time(imagefile, "open"):
+		fileHash = cache.fileHash(imagefile)
+		imp = cache.image(cache.key(fileHash, channels), lambda: CZIopener(imagefile, channels))
+	nuclear = imp.getImageStack().getProcessor(slices["nuclear"])
+	bait = imp.getImageStack().getProcessor(slices["bait"])
+	nuclei, table = {}, []
+	for parameters in grid:
+		sweep = [parameters[label] for label in sweepLabels]
+		nucleiKey = cache.key(fileHash, parameters['nuclear'], parameters['lower nuclear area'], parameters['upper nuclear area'], parameters['nucleus downsampling'])
+		if nucleiKey not in nuclei:
+			with profile.time(imagefile, "findnucleus") as timer:
+				nuclei[nucleiKey] = cache.rois(nucleiKey, lambda: findnucleus(ImagePlus('nuclear', nuclear).duplicate(), parameters))
+				timer.count = Overlay.size(nuclei[nucleiKey]) if nuclei[nucleiKey] else 0
+		if not nuclei[nucleiKey]:
+			log.log("no nuclei called in {0} with {1}".format(imageLabels['snapName'], sweep))
 			continue
-		for cell in image:
-			for i, value in enumerate(cell):
-				if i%colLen == 0:
-					table.incrementCounter()
-				col = colnames.popleft()
-				table.addValue(col, value)
-				colnames.append(col)
+		DAPIoverlay = nuclei[nucleiKey].duplicate()
+		totalnuclei = Overlay.size(DAPIoverlay)
+		images = {'bait': ImagePlus('bait', bait).duplicate()}
+		arrayKey = cache.key(nucleiKey, parameters['bait'], parameters['lower array area'], parameters['upper array area'], parameters['lower threshold'], parameters['upper threshold'])
+		with profile.time(imagefile, "findarray") as timer:
+			baitoverlay = cache.rois(arrayKey, lambda: findarray(images, DAPIoverlay, totalnuclei, parameters))
+			timer.count = Overlay.size(baitoverlay) if baitoverlay else 0
+		if not baitoverlay:
+			log.log("no arrays coincident with called nuclei in {0} with {1}".format(imageLabels['snapName'], sweep))
+			continue
+		totalarray = Overlay.size(baitoverlay)
+		with profile.time(imagefile, "nucFilter") as timer:
+			DAPIoverlay, totalnuclei = nucFilter(DAPIoverlay, baitoverlay, totalarray, totalnuclei)
+			timer.count = totalnuclei
+		with profile.time(imagefile, "nucArraypairer") as timer:
+			finalOverlay = nucArraypairer(DAPIoverlay, baitoverlay, totalarray, totalnuclei)
+			timer.count = Overlay.size(finalOverlay) // 3
+		with profile.time(imagefile, "measureImage") as timer:
+			rows = measureImage(imp, finalOverlay, slices, imageLabels)
+			timer.count = len(rows)
+		log.log("{0} rows measured in {1} with {2}".format(len(rows), imageLabels['snapName'], sweep))
+		table += [sweep + row for row in rows]
 	return table
 
-def roiSaver(overlay, output, name):
-	"""move overlay to roimanager and save"""
-	rm = RoiManager.getInstance()
-	if not rm:
-		rm = RoiManager()
-	rm.reset()
-	for roi in overlay:
-		rm.addRoi(roi)
-	rm.deselect()
-	resultsSaver("roi", output, name + "_rois", ".zip")
-	#rm.runCommand("save selected", outputDir + name + "_rois.zip")
+def tilePairs(imp, core, region, slices, parameters, levels, profile, key):
+	"""nucleus, array and nucleoplasm rois of the pairs whose nucleus is centred in core, from imp, the region around it"""
+	images = {}
+	images['nuclear'] = ImagePlus('nuclear', imp.getImageStack().getProcessor(slices["nuclear"])).duplicate()
+	images['bait'] = ImagePlus('bait', imp.getImageStack().getProcessor(slices["bait"])).duplicate()
+	pairs = Overlay()
+	with profile.time(key, "findnucleus") as timer:
+		DAPIoverlay = cutNuclei(images['nuclear'].getProcessor(), levels['nuclear cut'], parameters)
+		timer.count = Overlay.size(DAPIoverlay) if DAPIoverlay else 0
+	if not DAPIoverlay:
+		return pairs
+	totalnuclei = Overlay.size(DAPIoverlay)
+	with profile.time(key, "findarray") as timer:
+		baitoverlay = findarray(images, DAPIoverlay, totalnuclei, parameters, displayRange = levels['bait range'])
+		timer.count = Overlay.size(baitoverlay) if baitoverlay else 0
+	if not baitoverlay:
+		return pairs
+	with profile.time(key, "nucFilter") as timer:
+		DAPIoverlay, totalnuclei = nucFilter(DAPIoverlay, baitoverlay, Overlay.size(baitoverlay), totalnuclei)
+		timer.count = totalnuclei
+	with profile.time(key, "nucArraypairer") as timer:
+		finalOverlay = nucArraypairer(DAPIoverlay, baitoverlay, Overlay.size(baitoverlay), totalnuclei)
+		timer.count = Overlay.size(finalOverlay) // 3
+	#nucleus, array and nucleoplasm of each pair are consecutive; a pair belongs to the tile holding its nucleus' centre
+	for k in range(0, Overlay.size(finalOverlay), 3):
+		bounds = finalOverlay.get(k).getBounds()
+		if core.contains(region.x + bounds.x + bounds.width // 2, region.y + bounds.y + bounds.height // 2):
+			for roi in [finalOverlay.get(k), finalOverlay.get(k + 1), finalOverlay.get(k + 2)]:
+				pairs.add(roi)
+	return pairs
+
+def tileProcessor(imagefile, parameters, outputDir, log, channels, slices, imageLabels, profile):
+	"""imageProcessor for stitched mosaics too large to process whole, processed as overlapping tiles"""
+	czi = cziAccess(imagefile, True)
+	try:
+		CZIinfo = czi.info()
+		size, overlap = parameters['tile size'], parameters['tile overlap']
+		mosaic = Rectangle(CZIinfo['SizeX'], CZIinfo['SizeY'])
+		tiles = []
+		for y in range(0, mosaic.height, size):
+			for x in range(0, mosaic.width, size):
+				core = Rectangle(x, y, size, size).intersection(mosaic)
+				tiles.append((core, Rectangle(x - overlap, y - overlap, size + 2 * overlap, size + 2 * overlap).intersection(mosaic)))
+		log.log("{0} ({1} x {2} pixels) split into {3} tiles".format(imageLabels['snapName'], mosaic.width, mosaic.height, len(tiles)))
+		with profile.time(imagefile, "mosaicLevels"):
+			levels = mosaicLevels([tile[0] for tile in tiles], lambda core: czi.openImage(0, channels, core), mosaic, slices)
+	finally:
+		czi.close()
+	if levels is None:
+		log.log("no nuclei identified in snap {0}".format(imageLabels['snapName']))
+		return None
+	tasks = [tileTask(imagefile, tile[0], tile[1], channels, slices, parameters, levels, imageLabels, profile) for tile in tiles]
+	finalOverlay, table = Overlay(), []
+	pool = Executors.newFixedThreadPool(parameters['parallel images'])
+	try:
+		futures = [pool.submit(task) for task in tasks]
+		for task, future in zip(tasks, futures):
+			pairs, rows = future.get()
+			numbers = {}
+			for i in range(Overlay.size(pairs)):
+				roi = pairs.get(i)
+				prefix, number = roi.getName().rsplit("_", 1)
+				if number not in numbers:
+					numbers[number] = str(Overlay.size(finalOverlay) // 3 + 1)
+				roi.setName(prefix + "_" + numbers[number])
+				roi.setLocation(roi.getXBase() + task.region.x, roi.getYBase() + task.region.y)
+				finalOverlay.add(roi)
+			for row in rows:
+				prefix, number = row[4].rsplit("_", 1)
+				row[4] = prefix + "_" + numbers[number]
+			table += rows
+	finally:
+		pool.shutdown()
+	if Overlay.size(finalOverlay) == 0:
+		log.log("no single coincident arrays and nuclei identified in snap {0}".format(imageLabels['snapName']))
+		return None
+	log.log("{0} nucleus-array pairs found in {1}".format(Overlay.size(finalOverlay) // 3, imageLabels['snapName']))
+	with profile.time(imagefile, "roiSaver") as timer:
+		roiSaver(finalOverlay, outputDir, imageLabels['snapName'], log)
+		timer.count = Overlay.size(finalOverlay)
+	return table
 
 if __name__ in ["__builtin__", "__main__"]:
-	processDirectory(inputDir)
+	processDirectory(inputDir, parameterFile, cacheDir, cacheLimit, showResults, collectRois)
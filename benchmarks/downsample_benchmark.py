@@ -0,0 +1,55 @@
+#### benchmark of nucleus calling on a binned nuclear plane (F2H_processing.findnucleusDownsampled) against calling at full resolution
+### synthetic nuclear frames are called at each downsampling factor; the nuclei found are matched to those called at full resolution
+### by their overlap, and the counts, the mean overlap (intersection over union) of matched nuclei and the timings are reported
+
+#@ File (label="ImageJ-plugins directory", style="directory") repoDir
+#@ String (label="frame sizes (pixels)", value="2048,4096") frameSizes
+#@ String (label="downsampling factors", value="2,4") factors
+
+import sys
+sys.path.append(repoDir.getAbsolutePath())
+sys.path.append(repoDir.getAbsolutePath() + "/benchmarks")
+sys.path.append(repoDir.getAbsolutePath() + "/jars/Lib")
+
+from ij import ImagePlus
+from java.lang import System
+
+import F2H_processing
+import synthetic
+
+def timed(function, *args):
+	start = System.nanoTime()
+	result = function(*args)
+	return (System.nanoTime() - start) / 1e6, result
+
+def matched(reference, overlay):
+	"""intersection over union of every reference nucleus with the nucleus of overlay it overlaps most (0 if none)"""
+	masks = [F2H_processing.roiMask(overlay.get(j)) for j in range(overlay.size())] if overlay else []
+	index = F2H_processing.roiIndex(masks)
+	scores = []
+	for i in range(reference.size()):
+		first = F2H_processing.roiMask(reference.get(i))
+		firstArea = len(reference.get(i).getContainedPoints())
+		best = 0
+		for j in index.candidates(first[0]):
+			overlap = F2H_processing.overlapArea(first, masks[j])
+			if overlap > 0:
+				best = max(best, overlap / float(firstArea + len(overlay.get(j).getContainedPoints()) - overlap))
+		scores.append(best)
+	return scores
+
+for size in [int(i) for i in frameSizes.split(",")]:
+	nuclei = synthetic.ovalOverlay(int(40 * size * size / 1e6), size, size, 60, 140, size)
+	ip = synthetic.blobImage([(nuclei, 3000)], size, size, 200, 2, size + 1)
+	parameters = {'lower nuclear area': 1000, 'upper nuclear area': 20000, 'nucleus downsampling': 1}
+	fullTime, reference = timed(F2H_processing.findnucleus, ImagePlus("nuclear", ip.duplicate()), parameters)
+	if not reference:
+		print "{0} px: no nuclei called at full resolution".format(size)
+		continue
+	print "{0} px, full resolution: {1} nuclei in {2:.0f} ms".format(size, reference.size(), fullTime)
+	for factor in [int(i) for i in factors.split(",")]:
+		parameters['nucleus downsampling'] = factor
+		time, overlay = timed(F2H_processing.findnucleus, ImagePlus("nuclear", ip.duplicate()), parameters)
+		scores = matched(reference, overlay)
+		print "{0} px, downsampled {1}x: {2} nuclei in {3:.0f} ms ({4:.1f}x faster), {5} of {6} matched, mean overlap {7:.3f}".format(size, factor,
+			overlay.size() if overlay else 0, time, fullTime / time if time else 0, len([score for score in scores if score > 0]), len(scores), sum(scores) / len(scores))
@@ -0,0 +1,268 @@
+#### benchmark and checks of the cell-nucleus matching in subcell_loc.py
+### imageProperties.matchCells (overlap areas of candidate pairs + assignPairs) is checked on small hand built fields, where
+### the pairs of both matchCells and the roiFilter/unmatchedFilter passes it replaced are known, and on a field of separate
+### cells, where both must agree. On crowded fields every pair matchCells makes or leaves out is checked against the rule of
+### assignPairs and the timings of both are reported; the original passes are only run up to legacyLimit cells, and as they
+### stop with an error or lose uncontested pairs on most crowded fields, their pairs are reported there, not compared
+
+#@ File (label="ImageJ-plugins directory", style="directory") repoDir
+#@ String (label="cell counts", value="25,100,400,1600") cellCounts
+#@ Integer (label="largest cell count for the original passes", value=400) legacyLimit
+
+import sys
+sys.path.append(repoDir.getAbsolutePath())
+sys.path.append(repoDir.getAbsolutePath() + "/benchmarks")
+sys.path.append(repoDir.getAbsolutePath() + "/jars/Lib")
+
+from ij.gui import OvalRoi, Overlay, Roi
+from java.lang import System
+
+import subcell_loc
+import synthetic
+
+class legacyProperties(subcell_loc.imageProperties):
+	"""imageProperties with the matching passes used before matchCells"""
+	def roiFilter(self, cellCount, nucleiCount, outerType):
+		if outerType == "cell":
+			outerOverlay, innerOverlay, outerCount, innerCount = self.cellOverlay, self.DAPIoverlay, cellCount, nucleiCount
+		else:
+			outerOverlay, innerOverlay, outerCount, innerCount = self.DAPIoverlay, self.cellOverlay, nucleiCount, cellCount
+		i = 0
+		while i < outerCount:
+			overlapIndex, overlapTestList = [], []
+			roi = outerOverlay.get(i)
+			outerPoints = roi.getContainedPoints()
+			j = 0
+			while j < innerCount:
+				roi2 = innerOverlay.get(j)
+				innerPoints = roi2.getContainedPoints()
+				overlapTest = len(set(outerPoints) & set(innerPoints))
+				if overlapTest != 0:
+					overlapIndex.append(j)
+					overlapTestList.append(overlapTest)
+				if j == innerCount - 1 and len(overlapIndex) == 1:
+					roi4 = innerOverlay.get(overlapIndex[0])
+					roi4.setName("unique" + outerType + str(i)+ str(j))
+					roi.setName("unique" + outerType + str(i)+ str(j))
+				if j == innerCount - 1 and len(overlapIndex) > 1:
+					maxInd = overlapTestList.index(max(overlapTestList))
+					tempMax = overlapIndex[maxInd]
+					roi4 = innerOverlay.get(tempMax)
+					if roi4.getName() is None:
+						roi4.setName(outerType + str(i)+ str(j))
+						roi.setName(outerType + str(i)+ str(j))
+					else:
+						while "unique" in roi4.getName():
+							overlapIndex.remove(tempMax)
+							overlapTestList.remove(max(overlapTestList))
+							if len(overlapIndex) == 0:
+								break
+							maxInd = overlapTestList.index(max(overlapTestList))
+							tempMax = overlapIndex[maxInd]
+							roi4 = innerOverlay.get(tempMax)
+						if len(overlapIndex) > 0:
+							roi4.setName(outerType + str(i)+ str(j))
+							roi.setName(outerType + str(i)+ str(j))
+				j += 1
+			if len(overlapIndex) == 0:
+				outerOverlay.remove(roi)
+				outerCount -= 1
+			else:
+				if i == outerCount - 1:
+					for k in range(innerCount):
+						roi3 = innerOverlay.get(i)
+						if innerOverlay.contains(roi3) == True:
+							if roi3.getName() is None:
+								innerOverlay.remove(roi3)
+								innerCount -= 1
+								if innerOverlay == 0:
+									return None, None
+						else:
+							innerCount = k
+							break
+				i += 1
+		if outerType == "cell":
+			self.cellOverlay, self.DAPIoverlay, cellCount, nucleiCount = outerOverlay, innerOverlay, outerCount, innerCount
+		else:
+			self.DAPIoverlay, self.cellOverlay, nucleiCount, cellCount = outerOverlay, innerOverlay, outerCount, innerCount
+		return cellCount, nucleiCount
+
+	def unmatchedFilter(self, cellCount, nucleiCount):
+		for i in range(cellCount):
+			roi = self.cellOverlay.get(i)
+			Rname = roi.getName()
+			if self.DAPIoverlay.contains(self.DAPIoverlay.get(Rname)) == False:
+				roi.setName("unmatched" + str(i))
+		for i in range(nucleiCount):
+			roi = self.DAPIoverlay.get(i)
+			Rname = roi.getName()
+			if self.cellOverlay.contains(self.cellOverlay.get(Rname)) == False:
+				roi.setName("unmatched" + str(i))
+		for i in range(cellCount):
+			roi = self.cellOverlay.get(i)
+			Rname = roi.getName()
+			if "unmatched" in Rname:
+				for j in range(nucleiCount):
+					roi2 = self.DAPIoverlay.get(i)
+					if self.DAPIoverlay.contains(roi2) == True:
+						Rname2 = roi2.getName()
+						if "unmatched" in Rname2:
+							cellPoints = roi.getContainedPoints()
+							nucPoints = roi2.getContainedPoints()
+							overlapTest = bool(set(cellPoints) & set(nucPoints))
+							if overlapTest == True:
+								roi.setName("name" + str(i))
+								roi2.setName("name" + str(i))
+		i = 0
+		while i < cellCount:
+			roi = self.cellOverlay.get(i)
+			Rname = roi.getName()
+			roi2 = self.DAPIoverlay.get(Rname)
+			if self.DAPIoverlay.contains(roi2) == True:
+				roi.setName("cell_" + str(i))
+				roi2.setName("nucleus_" + str(i))
+				i += 1
+			else:
+				self.cellOverlay.remove(roi)
+				cellCount -= 1
+		return cellCount
+
+	def legacyMatch(self):
+		cellCount, nucleiCount = Overlay.size(self.cellOverlay), Overlay.size(self.DAPIoverlay)
+		cellCount, nucleiCount = self.roiFilter(cellCount, nucleiCount, "cell")
+		if cellCount is None:
+			return 0
+		cellCount, nucleiCount = self.roiFilter(cellCount, nucleiCount, "DAPI")
+		if cellCount is None:
+			return 0
+		return self.unmatchedFilter(cellCount, nucleiCount)
+
+def pairs(properties, cellCount, cellIDs, nucleusIDs):
+	"""the matched (cell, nucleus) pairs as indices into the original overlays"""
+	found = set()
+	for k in range(cellCount):
+		cell = properties.cellOverlay.get("cell_" + str(k))
+		nucleus = properties.DAPIoverlay.get("nucleus_" + str(k))
+		if cell is not None and nucleus is not None:
+			found.add((cellIDs[System.identityHashCode(cell)], nucleusIDs[System.identityHashCode(nucleus)]))
+	return found
+
+def timedMatch(properties, cells, nuclei, match):
+	properties.cellOverlay, properties.DAPIoverlay = cells.duplicate(), nuclei.duplicate()
+	cellIDs = dict((System.identityHashCode(properties.cellOverlay.get(i)), i) for i in range(cells.size()))
+	nucleusIDs = dict((System.identityHashCode(properties.DAPIoverlay.get(i)), i) for i in range(nuclei.size()))
+	start = System.nanoTime()
+	cellCount = match()
+	elapsed = (System.nanoTime() - start) / 1e6
+	return elapsed, pairs(properties, cellCount, cellIDs, nucleusIDs)
+
+#small fields of rectangles (x, y, width, height) as cells and nuclei, with the pairs (cell index, nucleus index) of matchCells
+#and of the original passes ("error" where those stop with an exception); see the README for why they differ
+handBuilt = [
+	("unique pair", [(0, 0, 20, 20)], [(5, 5, 5, 5)], [(0, 0)], [(0, 0)]),
+	("cell without a nucleus", [(0, 0, 20, 20), (30, 0, 20, 20), (60, 0, 20, 20)], [(35, 5, 5, 5)], [(1, 0)], [(1, 0)]),
+	("only nucleus of two cells", [(0, 0, 20, 20), (18, 0, 20, 20)], [(10, 5, 10, 5)], [(0, 0)], [(1, 0)]),
+	("largest nucleus claimed by another cell", [(0, 0, 20, 20), (18, 0, 20, 20)], [(15, 5, 8, 5), (30, 5, 4, 4)], [(0, 0), (1, 1)], "error"),
+	("two cells contest a third nucleus", [(0, 0, 20, 20), (18, 0, 20, 20)], [(17, 5, 10, 5), (2, 2, 6, 6), (30, 5, 3, 3)], [(0, 1), (1, 2)], []),
+	("nucleus lying in one cell only", [(0, 0, 20, 20), (18, 0, 20, 20)], [(8, 5, 12, 5), (2, 2, 3, 3), (30, 5, 4, 4)], [(0, 1), (1, 2)], [(0, 0), (1, 2)]),
+]
+
+def rectangles(boxes):
+	overlay = Overlay()
+	for x, y, width, height in boxes:
+		overlay.add(Roi(x, y, width, height))
+	return overlay
+
+def separateField(count):
+	"""count cells on a grid with room between them, each with one nucleus inside"""
+	cells, nuclei = Overlay(), Overlay()
+	side = int(count ** 0.5) + 1
+	for i in range(count):
+		x, y = 250 * (i % side), 250 * (i // side)
+		cells.add(OvalRoi(x, y, 200, 180))
+		nuclei.add(OvalRoi(x + 60 + i % 7, y + 50 + i % 5, 70, 60))
+	return cells, nuclei
+
+def ruleProblems(cells, nuclei, matched):
+	"""pairs of matched that break the rule of assignPairs: every pair must overlap and use its cell and nucleus once, every cell
+	and nucleus overlapping only each other must be paired, and every overlapping pair left out must have its cell or its nucleus
+	paired by a pair ranked before it (unique pairs first, then by decreasing overlap, ties to the lower indices)"""
+	cellMasks = [subcell_loc.roiMask(cells.get(i)) for i in range(cells.size())]
+	nucleusMasks = [subcell_loc.roiMask(nuclei.get(i)) for i in range(nuclei.size())]
+	nucleusIndex = subcell_loc.roiIndex(nucleusMasks)
+	overlaps, cellDegree, nucleusDegree = {}, {}, {}
+	for cell, cellMask in enumerate(cellMasks):
+		for nucleus in nucleusIndex.candidates(cellMask[0]):
+			area = subcell_loc.overlapArea(cellMask, nucleusMasks[nucleus])
+			if area > 0:
+				overlaps[(cell, nucleus)] = area
+				cellDegree[cell] = cellDegree.get(cell, 0) + 1
+				nucleusDegree[nucleus] = nucleusDegree.get(nucleus, 0) + 1
+	rank = lambda pair: (not (cellDegree[pair[0]] == 1 or nucleusDegree[pair[1]] == 1), -overlaps[pair], pair[0], pair[1])
+	cellPartner, nucleusPartner, problems = {}, {}, []
+	for cell, nucleus in sorted(matched):
+		if (cell, nucleus) not in overlaps or cell in cellPartner or nucleus in nucleusPartner:
+			problems.append((cell, nucleus))
+		cellPartner[cell], nucleusPartner[nucleus] = nucleus, cell
+	for pair in sorted(overlaps):
+		if pair in matched:
+			continue
+		cell, nucleus = pair
+		before = [partner for partner in [(cell, cellPartner.get(cell)), (nucleusPartner.get(nucleus), nucleus)] if None not in partner and rank(partner) < rank(pair)]
+		if before == []:
+			problems.append(pair)
+	return problems
+
+def legacyPairs(cells, nuclei):
+	"""pairs of the original passes, or "error" if they stop with an exception"""
+	legacy = legacyProperties()
+	legacy.imageLabels = {'snapName': 'synthetic', 'snapNo': '1'}
+	try:
+		return timedMatch(legacy, cells, nuclei, legacy.legacyMatch)
+	except:
+		return 0, "error"
+
+failed = []
+for name, cellBoxes, nucleusBoxes, expected, legacyExpected in handBuilt:
+	cells, nuclei = rectangles(cellBoxes), rectangles(nucleusBoxes)
+	properties = subcell_loc.imageProperties()
+	properties.imageLabels = {'snapName': 'synthetic', 'snapNo': '1'}
+	matched = timedMatch(properties, cells, nuclei, properties.matchCells)[1]
+	legacyMatched = legacyPairs(cells, nuclei)[1]
+	legacyMatched = legacyMatched if legacyMatched == "error" else sorted(legacyMatched)
+	print "{0}: matchCells {1}, original passes {2}".format(name, sorted(matched), legacyMatched)
+	if sorted(matched) != expected:
+		failed.append("{0}: matchCells gives {1}, not {2}".format(name, sorted(matched), expected))
+	if legacyMatched != legacyExpected:
+		failed.append("{0}: the original passes give {1}, not {2}".format(name, legacyMatched, legacyExpected))
+
+cells, nuclei = separateField(100)
+properties = subcell_loc.imageProperties()
+properties.imageLabels = {'snapName': 'synthetic', 'snapNo': '1'}
+matchTime, matched = timedMatch(properties, cells, nuclei, properties.matchCells)
+legacyTime, legacyMatched = legacyPairs(cells, nuclei)
+print "separate cells: matchCells {0} pairs, original passes {1}".format(len(matched), legacyMatched if legacyMatched == "error" else "{0} pairs".format(len(legacyMatched)))
+if matched != legacyMatched or len(matched) != cells.size():
+	failed.append("separate cells: the pairs differ")
+
+for count in [int(i) for i in cellCounts.split(",")]:
+	#cells packed at roughly their own area so most touch several neighbours
+	size = int((count * 160 * 160) ** 0.5) + 200
+	cells = synthetic.ovalOverlay(count, size, size, 120, 220, count)
+	nuclei = synthetic.arrayOverlay(cells, count + count // 4, size, size, 40, 80, count + 1)
+	properties = subcell_loc.imageProperties()
+	properties.imageLabels = {'snapName': 'synthetic', 'snapNo': '1'}
+	matchTime, matched = timedMatch(properties, cells, nuclei, properties.matchCells)
+	report = "{0} cells, {1} nuclei: matchCells {2:.0f} ms ({3} pairs)".format(count, nuclei.size(), matchTime, len(matched))
+	problems = ruleProblems(cells, nuclei, matched)
+	if problems:
+		failed.append("{0} cells: {1} pairs break the matching rule, e.g. {2}".format(count, len(problems), problems[0]))
+	if count <= legacyLimit:
+		legacyTime, legacyMatched = legacyPairs(cells, nuclei)
+		if legacyMatched == "error":
+			report += ", original passes stop with an error"
+		else:
+			report += ", original passes {0:.0f} ms ({1} pairs, {2} in common)".format(legacyTime, len(legacyMatched), len(matched & legacyMatched))
+	print report
+assert failed == [], "; ".join(failed)
+print "matchCells pairs as expected"
@@ -0,0 +1,71 @@
+#### benchmark of F2H_processing.roiStatistics against the per roi, per channel roi.getStatistics() loop it replaced in measureImage
+### every roi of a synthetic multichannel frame is measured in every channel both ways; the area, mean and median
+### must be identical before the timings are reported
+
+#@ File (label="ImageJ-plugins directory", style="directory") repoDir
+#@ String (label="roi counts", value="100,1000,10000") roiCounts
+#@ String (label="channel counts", value="2,8") channelCounts
+
+import sys
+sys.path.append(repoDir.getAbsolutePath())
+sys.path.append(repoDir.getAbsolutePath() + "/benchmarks")
+sys.path.append(repoDir.getAbsolutePath() + "/jars/Lib")
+
+from ij import ImagePlus, ImageStack
+from ij.gui import OvalRoi, Overlay
+from ij.measure import Calibration
+from java.lang import System
+
+import F2H_processing
+import synthetic
+
+def legacyStatistics(imp, overlay, channels):
+	"""the measureImage loop before roiStatistics"""
+	results = []
+	imp.setOverlay(overlay)
+	for label, channel in channels:
+		imp.setSlice(channel)
+		for i in range(Overlay.size(overlay)):
+			roi = overlay.get(i)
+			roi.setImage(imp)
+			roi.setPosition(imp)
+			roiStat = roi.getStatistics()
+			results.append((label, i, roiStat.area, roiStat.mean, roiStat.median))
+	return results
+
+def engineStatistics(imp, overlay, channels):
+	return [(label, i, roiStat.area, roiStat.mean, roiStat.median) for label, i, roiStat in F2H_processing.roiStatistics(imp, overlay, channels)]
+
+def timed(function, *args):
+	start = System.nanoTime()
+	result = function(*args)
+	return (System.nanoTime() - start) / 1e6, result
+
+failed = []
+for count in [int(i) for i in roiCounts.split(",")]:
+	size = int((count * 40 * 40) ** 0.5) + 100
+	overlay = synthetic.ovalOverlay(count, size, size, 10, 40, count)
+	#rois reaching outside the frame are clipped by ImageJ
+	overlay.add(OvalRoi(-10, -10, 40, 40))
+	overlay.add(OvalRoi(size - 30, size - 20, 40, 40))
+	for channelCount in [int(i) for i in channelCounts.split(",")]:
+		stack = ImageStack(size, size)
+		for c in range(channelCount):
+			stack.addSlice("c:{0}".format(c + 1), synthetic.paintedImage([(overlay, 500 + 300 * c)], size, size, 100 + 20 * c, count + c))
+		imp = ImagePlus("synthetic", stack)
+		calibration = Calibration()
+		calibration.pixelWidth = calibration.pixelHeight = 0.1
+		calibration.setUnit("micron")
+		imp.setCalibration(calibration)
+		channels = [("c{0}".format(c + 1), c + 1) for c in range(channelCount)]
+		legacyTime, legacy = timed(legacyStatistics, imp, overlay, channels)
+		imp.deleteRoi()
+		engineTime, engine = timed(engineStatistics, imp, overlay, channels)
+		if legacy != engine:
+			mismatches = [pair for pair in zip(legacy, engine) if pair[0] != pair[1]]
+			failed.append("{0} rois x {1} channels: {2} measurements differ, e.g. {3}".format(count, channelCount, len(mismatches), mismatches[0]))
+			print failed[-1]
+			continue
+		print "{0} rois x {1} channels: roi.getStatistics {2:.0f} ms, roiStatistics {3:.0f} ms".format(count, channelCount, legacyTime, engineTime)
+assert failed == [], "; ".join(failed)
+print "measurements identical"
@@ -0,0 +1,98 @@
+#### benchmark of the nucleus/array overlap engine used by nucFilter and nucArraypairer in F2H_processing.py
+### times the engine on synthetic overlays with thousands of rois and checks that it pairs the same nuclei and arrays
+### as the original all-pairs comparison of contained point sets (run on a smaller overlay, as it is far slower)
+
+#@ File (label="ImageJ-plugins directory", style="directory") repoDir
+#@ Integer (label="nuclei", value=2000) nucleusCount
+#@ Integer (label="arrays", value=4000) arrayCount
+#@ Integer (label="nuclei for the comparison with the original", value=150) legacyCount
+
+import sys
+sys.path.append(repoDir.getAbsolutePath())
+sys.path.append(repoDir.getAbsolutePath() + "/benchmarks")
+sys.path.append(repoDir.getAbsolutePath() + "/jars/Lib")
+
+from ij.gui import Overlay, Roi, ShapeRoi
+from java.lang import System
+
+import F2H_processing
+import synthetic
+
+def legacyNucFilter(DAPIoverlay, baitoverlay, totalarray, totalnuclei):
+	"""nucFilter before the overlap engine"""
+	j = list(range(totalarray))
+	i = 0
+	while i < totalnuclei:
+		roi = DAPIoverlay.get(i)
+		nucPoints = roi.getContainedPoints()
+		overlapCounter = 0
+		for k, element in enumerate(j):
+			roi2 = baitoverlay.get(element)
+			arrayPoints = roi2.getContainedPoints()
+			overlapTest = bool(set(arrayPoints) & set(nucPoints))
+			if overlapTest == True:
+				j.remove(element)
+				overlapCounter += 1
+		if overlapCounter != 1:
+			DAPIoverlay.remove(roi)
+			totalnuclei -= 1
+		else:
+			i += 1
+	return DAPIoverlay, totalnuclei
+
+def legacyNucArraypairer(DAPIoverlay, baitoverlay, totalarray, totalnuclei):
+	"""nucArraypairer before the overlap engine"""
+	finalOverlay = Overlay()
+	j = list(range(totalarray))
+	for i in range(totalnuclei):
+		tempNo = str(i + 1)
+		roi = DAPIoverlay.get(i)
+		nucPoints = roi.getContainedPoints()
+		for k, element in enumerate(j):
+			roi2 = baitoverlay.get(element)
+			arrayPoints = roi2.getContainedPoints()
+			overlapTest = bool(set(arrayPoints) & set(nucPoints))
+			if overlapTest == False:
+				continue
+			nucleoplasm = ShapeRoi(roi).not(ShapeRoi(roi2))
+			Roi.setName(roi, "nucleus_" + tempNo)
+			Roi.setName(roi2, "array_" + tempNo)
+			Roi.setName(nucleoplasm, "nucleoplasm_" + tempNo)
+			finalOverlay.add(roi)
+			finalOverlay.add(roi2)
+			finalOverlay.add(nucleoplasm)
+			j.remove(element)
+			break
+	return finalOverlay
+
+def pairing(nucFilter, nucArraypairer, nuclei, arrays):
+	"""run a filter/pairer implementation on copies of the overlays; return the elapsed ms and the paired rois"""
+	nuclei, arrays = nuclei.duplicate(), arrays.duplicate()
+	start = System.nanoTime()
+	nuclei, totalnuclei = nucFilter(nuclei, arrays, arrays.size(), nuclei.size())
+	finalOverlay = nucArraypairer(nuclei, arrays, arrays.size(), totalnuclei)
+	elapsed = (System.nanoTime() - start) / 1e6
+	pairs = [(roi.getName(), str(roi.getBounds())) for roi in finalOverlay]
+	return elapsed, pairs
+
+def frameSize(count):
+	"""square frame holding count nuclei at roughly the density of a confluent snap"""
+	return int((count * 150 * 150) ** 0.5) + 200
+
+size = frameSize(legacyCount)
+nuclei = synthetic.ovalOverlay(legacyCount, size, size, 60, 140, 1)
+arrays = synthetic.arrayOverlay(nuclei, 2 * legacyCount, size, size, 3, 14, 2)
+legacyTime, legacyPairs = pairing(legacyNucFilter, legacyNucArraypairer, nuclei, arrays)
+engineTime, enginePairs = pairing(F2H_processing.nucFilter, F2H_processing.nucArraypairer, nuclei, arrays)
+print "{0} nuclei x {1} arrays: original {2:.0f} ms, engine {3:.0f} ms, {4} rois paired".format(legacyCount, 2 * legacyCount, legacyTime, engineTime, len(enginePairs))
+failed = []
+if legacyPairs != enginePairs:
+	failed.append("{0} nuclei: the overlap engine paired different rois from the original".format(legacyCount))
+
+size = frameSize(nucleusCount)
+nuclei = synthetic.ovalOverlay(nucleusCount, size, size, 60, 140, 3)
+arrays = synthetic.arrayOverlay(nuclei, arrayCount, size, size, 3, 14, 4)
+engineTime, enginePairs = pairing(F2H_processing.nucFilter, F2H_processing.nucArraypairer, nuclei, arrays)
+print "{0} nuclei x {1} arrays: engine {2:.0f} ms, {3} rois paired".format(nucleusCount, arrayCount, engineTime, len(enginePairs))
+assert failed == [], "; ".join(failed)
+print "pairings identical"
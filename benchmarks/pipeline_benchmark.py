@@ -0,0 +1,127 @@
+#### benchmark suite for the processing stages of F2H_processing.py and subcell_loc.py
+### synthetic nuclear/prey/bait frames of gaussian blobs are generated for every combination of frame size, nucleus density and arrays
+### per nucleus, and findnucleus, findarray, nucFilter, nucArraypairer, measureImage (F2H) and matchCells (subcell) are run on each.
+### throughput (images/s, rois/s) and peak heap are reported per combination. Results can be saved as a baseline json
+### and later runs compared with it, flagging stages that got slower by more than the tolerance. Runs headless
+
+#@ File (label="ImageJ-plugins directory", style="directory") repoDir
+#@ String (label="frame sizes (pixels)", value="1024,2048") frameSizes
+#@ String (label="nuclei per megapixel", value="20,60") densities
+#@ String (label="arrays per nucleus", value="1,3") arrayCounts
+#@ Integer (label="repeats", value=3, min=1) repeats
+#@ File (label="baseline json (optional)", style="file", required=false) baselineFile
+#@ Boolean (label="save this run as the baseline", value=false) saveBaseline
+#@ Integer (label="regression tolerance (%)", value=20, min=0) tolerance
+#@ File (label="directory to save the synthetic frames as tiff (optional)", style="directory", required=false) fixtureDir
+
+import sys
+sys.path.append(repoDir.getAbsolutePath())
+sys.path.append(repoDir.getAbsolutePath() + "/benchmarks")
+sys.path.append(repoDir.getAbsolutePath() + "/jars/Lib")
+
+import json
+
+from ij import ImagePlus, ImageStack
+from ij.gui import Overlay
+from ij.io import FileSaver
+from java.io import File
+from java.lang.management import ManagementFactory, MemoryType
+
+import F2H_processing
+import subcell_loc
+import synthetic
+
+parameters = {'nuclear': 1, 'prey': 2, 'bait': 3, 'lower nuclear area': 1000, 'upper nuclear area': 20000,
+	'lower array area': 5, 'upper array area': 200, 'lower threshold': 50, 'upper threshold': 255}
+slices = {'nuclear': 1, 'prey': 2, 'bait': 3}
+stages = ["findnucleus", "findarray", "nucFilter", "nucArraypairer", "measureImage", "matchCells"]
+
+def syntheticFrame(size, density, arraysPerNucleus, seed):
+	"""nuclear, prey and bait planes of one frame as a stack, with an overlay of cells for matchCells: randomly placed ovals
+	of 120 to 220 pixels, independent of the nuclei, so some cells hold one nucleus, some several and some none"""
+	count = max(1, int(density * size * size / 1e6))
+	nuclei = synthetic.ovalOverlay(count, size, size, 60, 140, seed)
+	arrays = synthetic.arrayOverlay(nuclei, arraysPerNucleus * count, size, size, 3, 14, seed + 1)
+	cells = synthetic.ovalOverlay(count, size, size, 120, 220, seed + 2)
+	stack = ImageStack(size, size)
+	stack.addSlice("c:1", synthetic.blobImage([(nuclei, 3000)], size, size, 200, 2, seed + 3))
+	stack.addSlice("c:2", synthetic.blobImage([(nuclei, 800), (arrays, 1600)], size, size, 200, 1, seed + 4))
+	stack.addSlice("c:3", synthetic.blobImage([(arrays, 2000)], size, size, 200, 1, seed + 5))
+	imp = ImagePlus("synthetic", stack)
+	imp.setDimensions(3, 1, 1)
+	return imp, cells
+
+def heapPools():
+	return [pool for pool in ManagementFactory.getMemoryPoolMXBeans() if pool.getType() == MemoryType.HEAP]
+
+def runFrame(imp, cells, profile, key):
+	"""run every stage on one frame; returns the number of rois the stages produced"""
+	images = {'nuclear': ImagePlus('nuclear', imp.getImageStack().getProcessor(slices['nuclear'])).duplicate(),
+		'bait': ImagePlus('bait', imp.getImageStack().getProcessor(slices['bait'])).duplicate()}
+	imageLabels = {'imagefile': key, 'date': "", 'snapName': "synthetic"}
+	with profile.time(key, "findnucleus"):
+		DAPIoverlay = F2H_processing.findnucleus(images['nuclear'], parameters)
+	if not DAPIoverlay:
+		return 0
+	totalnuclei = Overlay.size(DAPIoverlay)
+	rois = totalnuclei
+	properties = subcell_loc.imageProperties()
+	properties.imageLabels = {'snapName': 'synthetic', 'snapNo': '1'}
+	properties.cellOverlay, properties.DAPIoverlay = cells.duplicate(), DAPIoverlay.duplicate()
+	with profile.time(key, "matchCells"):
+		rois += properties.matchCells()
+	with profile.time(key, "findarray"):
+		baitoverlay = F2H_processing.findarray(images, DAPIoverlay, totalnuclei, parameters)
+	if not baitoverlay:
+		return rois
+	totalarray = Overlay.size(baitoverlay)
+	rois += totalarray
+	with profile.time(key, "nucFilter"):
+		DAPIoverlay, totalnuclei = F2H_processing.nucFilter(DAPIoverlay, baitoverlay, totalarray, totalnuclei)
+	with profile.time(key, "nucArraypairer"):
+		finalOverlay = F2H_processing.nucArraypairer(DAPIoverlay, baitoverlay, totalarray, totalnuclei)
+	rois += Overlay.size(finalOverlay)
+	with profile.time(key, "measureImage"):
+		rois += len(F2H_processing.measureImage(imp, finalOverlay, slices, imageLabels))
+	return rois
+
+results = {}
+for size in [int(i) for i in frameSizes.split(",")]:
+	for density in [int(i) for i in densities.split(",")]:
+		for arraysPerNucleus in [int(i) for i in arrayCounts.split(",")]:
+			combination = "{0}px {1}/MP {2} arrays".format(size, density, arraysPerNucleus)
+			imp, cells = syntheticFrame(size, density, arraysPerNucleus, size + density + arraysPerNucleus)
+			if fixtureDir is not None:
+				FileSaver(imp).saveAsTiffStack(File(fixtureDir, combination.replace(" ", "_").replace("/", "per") + ".tif").getPath())
+			profile = F2H_processing.stageProfile()
+			for pool in heapPools():
+				pool.resetPeakUsage()
+			rois = 0
+			for repeat in range(repeats):
+				rois += runFrame(imp, cells, profile, combination)
+			peak = sum(pool.getPeakUsage().getUsed() for pool in heapPools()) / 1048576.0
+			times = dict((stage, 0.0) for stage in stages)
+			for image, stage, milliseconds, count, heap in profile.records:
+				times[stage] += milliseconds / repeats
+			seconds = sum(times.values()) / 1000
+			results[combination] = {'stages': times, 'images/s': 1 / seconds if seconds else 0, 'rois/s': rois / repeats / seconds if seconds else 0, 'peak MB': peak}
+			print "{0}: {1:.2f} images/s, {2:.0f} rois/s, peak heap {3:.0f} MB; ".format(combination, results[combination]['images/s'], results[combination]['rois/s'], peak) + ", ".join("{0} {1:.0f} ms".format(stage, times[stage]) for stage in stages)
+			imp.flush()
+
+if baselineFile is not None and baselineFile.exists() and not saveBaseline:
+	with open(baselineFile.getPath()) as baselineStream:
+		baseline = json.load(baselineStream)
+	regressions = 0
+	for combination in sorted(results):
+		if combination not in baseline:
+			continue
+		for stage in stages:
+			before, after = baseline[combination]['stages'].get(stage, 0), results[combination]['stages'][stage]
+			if before > 0 and after > before * (1 + tolerance / 100.0):
+				regressions += 1
+				print "slower: {0} {1} {2:.0f} ms -> {3:.0f} ms ({4:+.0f}%)".format(combination, stage, before, after, 100 * (after / before - 1))
+	print "{0} stage(s) slower than the baseline by more than {1}%".format(regressions, tolerance)
+if baselineFile is not None and saveBaseline:
+	with open(baselineFile.getPath(), 'w') as baselineStream:
+		json.dump(results, baselineStream, indent = 1, sort_keys = True)
+	print "baseline saved to {0}".format(baselineFile.getPath())
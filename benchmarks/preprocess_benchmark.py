@@ -0,0 +1,59 @@
+#### benchmark of the native preprocessing in F2H_processing.findnucleus and subcell_loc.binarize against the IJ.run command chains
+### synthetic nuclear frames are preprocessed both ways; the binary images and the called nuclei must be identical before the
+### per image latencies are reported
+
+#@ File (label="ImageJ-plugins directory", style="directory") repoDir
+#@ String (label="frame sizes (pixels)", value="1024,2048,4096") frameSizes
+#@ Integer (label="repeats", value=5, min=1) repeats
+
+import sys
+sys.path.append(repoDir.getAbsolutePath())
+sys.path.append(repoDir.getAbsolutePath() + "/benchmarks")
+sys.path.append(repoDir.getAbsolutePath() + "/jars/Lib")
+
+from ij import ImagePlus
+from java.lang import System
+from java.util import Arrays
+
+import F2H_processing
+import subcell_loc
+import synthetic
+
+parameters = {'lower nuclear area': 1000, 'upper nuclear area': 20000}
+
+def timed(function, *args):
+	start = System.nanoTime()
+	result = function(*args)
+	return (System.nanoTime() - start) / 1e6, result
+
+def outlines(overlay):
+	return [] if overlay is None else [tuple(overlay.get(i).getPolygon().xpoints) + tuple(overlay.get(i).getPolygon().ypoints) for i in range(overlay.size())]
+
+failed = []
+for size in [int(i) for i in frameSizes.split(",")]:
+	nuclei = synthetic.ovalOverlay(int(40 * size * size / 1e6), size, size, 60, 140, size)
+	ip = synthetic.blobImage([(nuclei, 3000)], size, size, 200, 2, size + 1)
+	times = {'findnucleus commands': 0, 'findnucleus native': 0, 'binarize commands': 0, 'binarize native': 0}
+	different = []
+	for repeat in range(repeats):
+		commands, native = ImagePlus("nuclear", ip.duplicate()), ImagePlus("nuclear", ip.duplicate())
+		commandTime, commandNuclei = timed(F2H_processing.findnucleus, commands, parameters, False)
+		nativeTime, nativeNuclei = timed(F2H_processing.findnucleus, native, parameters, True)
+		times['findnucleus commands'] += commandTime / repeats
+		times['findnucleus native'] += nativeTime / repeats
+		if not Arrays.equals(commands.getProcessor().getPixels(), native.getProcessor().getPixels()) or outlines(commandNuclei) != outlines(nativeNuclei):
+			different.append("findnucleus")
+		commands, native = ImagePlus("nuclear", ip.duplicate()), ImagePlus("nuclear", ip.duplicate())
+		commandTime, commands = timed(subcell_loc.binarize, commands, "DAPI", False)
+		nativeTime, native = timed(subcell_loc.binarize, native, "DAPI", True)
+		times['binarize commands'] += commandTime / repeats
+		times['binarize native'] += nativeTime / repeats
+		if not Arrays.equals(commands.getProcessor().getPixels(), native.getProcessor().getPixels()):
+			different.append("binarize")
+	if different:
+		failed.append("{0} px: native and command results differ in {1}".format(size, ", ".join(sorted(set(different)))))
+		print failed[-1]
+		continue
+	print "{0} px: ".format(size) + ", ".join("{0} {1:.1f} ms".format(key, times[key]) for key in sorted(times))
+assert failed == [], "; ".join(failed)
+print "native and command results identical"
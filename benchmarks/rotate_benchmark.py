@@ -0,0 +1,68 @@
+#### benchmark of rotateCrop.cropRotate in western_processor.py against rotating the whole exposure and then cropping
+### a synthetic 16-bit blot is rotated and cropped both ways for a range of crop sizes; the largest pixel difference
+### away from the image border (where java2d and ImageJ treat the missing neighbours differently) is reported with the timings
+### and must not exceed tolerance grey levels (rounding of the bilinear interpolation) beyond margin pixels of each edge
+
+#@ File (label="ImageJ-plugins directory", style="directory") repoDir
+#@ String (label="image sizes (pixels)", value="2048,4096") imageSizes
+#@ String (label="crop sizes (fraction of the image side)", value="0.1,0.3,0.6") cropFractions
+#@ Float (label="angle", value=7.5) angle
+
+import sys
+sys.path.append(repoDir.getAbsolutePath())
+sys.path.append(repoDir.getAbsolutePath() + "/benchmarks")
+sys.path.append(repoDir.getAbsolutePath() + "/jars/Lib")
+
+from ij import IJ, ImagePlus
+from ij.gui import Roi
+from java.lang import System
+
+import synthetic
+import western_processor
+
+def legacyProcess(rc, imp):
+	"""processImages before cropRotate"""
+	IJ.run(imp, "Rotate... ", "angle="+str(rc.angle)+ " grid=1 interpolation=Bilinear")
+	imp.setRoi(rc.roi)
+	return imp.crop()
+
+def timed(function, *args):
+	start = System.nanoTime()
+	result = function(*args)
+	return (System.nanoTime() - start) / 1e6, result
+
+def difference(imp, imp2, margin):
+	"""largest absolute difference of two equally sized images, ignoring margin pixels at each edge"""
+	ip, ip2 = imp.getProcessor(), imp2.getProcessor()
+	largest = 0
+	for y in range(margin, ip.getHeight() - margin):
+		for x in range(margin, ip.getWidth() - margin):
+			largest = max(largest, abs(ip.get(x, y) - ip2.get(x, y)))
+	return largest
+
+#pixels at each edge left out of the comparison, and the largest difference allowed beyond them
+margin = 2
+tolerance = 1
+
+failed = []
+for size in [int(i) for i in imageSizes.split(",")]:
+	#bands of blobs like a blot, lanes and bands at random
+	bands = synthetic.ovalOverlay(size // 40, size, size, size // 60, size // 20, size)
+	ip = synthetic.blobImage([(bands, 20000)], size, size, 1000, 4, size + 1)
+	for fraction in [float(i) for i in cropFractions.split(",")]:
+		side = int(size * fraction)
+		rc = western_processor.rotateCrop()
+		rc.angle = angle
+		#off centre, as membranes rarely sit in the middle of the exposure
+		rc.roi = Roi(size // 2 - side // 3, size // 2 - side // 2, side, side)
+		legacyTime, legacy = timed(legacyProcess, rc, ImagePlus("blot", ip.duplicate()))
+		fastTime, fast = timed(rc.processImages, ImagePlus("blot", ip.duplicate()))
+		if (legacy.getWidth(), legacy.getHeight()) != (fast.getWidth(), fast.getHeight()):
+			failed.append("{0} px, {1} px crop: cropRotate gives a {2}x{3} image instead of {4}x{5}".format(size, side, fast.getWidth(), fast.getHeight(), legacy.getWidth(), legacy.getHeight()))
+			continue
+		largest = difference(legacy, fast, margin)
+		print "{0} px, {1} px crop: rotate then crop {2:.0f} ms, cropRotate {3:.0f} ms, largest difference {4}".format(size, side, legacyTime, fastTime, largest)
+		if largest > tolerance:
+			failed.append("{0} px, {1} px crop: pixels differ by up to {2} grey levels".format(size, side, largest))
+assert failed == [], "; ".join(failed)
+print "cropRotate within {0} grey level(s) of rotate then crop".format(tolerance)
@@ -0,0 +1,65 @@
+### synthetic rois and images for the benchmarks in this directory
+### every generator takes a seed so repeated runs measure exactly the same input
+
+from ij.gui import Overlay, OvalRoi
+from ij.plugin.filter import GaussianBlur
+from ij.process import ImageProcessor, ShortProcessor
+
+from java.util import Random
+
+def ovalOverlay(count, width, height, minDiameter, maxDiameter, seed):
+	"""overlay of count randomly sized and placed ovals inside a width x height frame"""
+	random = Random(seed)
+	overlay = Overlay()
+	for i in range(count):
+		w = minDiameter + random.nextInt(maxDiameter - minDiameter + 1)
+		h = minDiameter + random.nextInt(maxDiameter - minDiameter + 1)
+		overlay.add(OvalRoi(random.nextInt(width - w), random.nextInt(height - h), w, h))
+	return overlay
+
+def arrayOverlay(nuclei, count, width, height, minDiameter, maxDiameter, seed):
+	"""overlay of count small ovals. Two thirds are placed inside randomly chosen rois of the nuclei overlay
+	(so some nuclei get one array and some several), the rest anywhere in the frame"""
+	random = Random(seed)
+	overlay = Overlay()
+	for i in range(count):
+		d = minDiameter + random.nextInt(maxDiameter - minDiameter + 1)
+		if random.nextInt(3) < 2 and nuclei.size() > 0:
+			bounds = nuclei.get(random.nextInt(nuclei.size())).getBounds()
+			x = bounds.x + random.nextInt(max(1, bounds.width - d))
+			y = bounds.y + random.nextInt(max(1, bounds.height - d))
+		else:
+			x = random.nextInt(width - d)
+			y = random.nextInt(height - d)
+		overlay.add(OvalRoi(x, y, d, d))
+	return overlay
+
+def paintedImage(overlays, width, height, background, seed):
+	"""16-bit image with noisy background; overlays is a list of (overlay, value) pairs painted in order"""
+	ip = ShortProcessor(width, height)
+	ip.setValue(background)
+	ip.fill()
+	ImageProcessor.setRandomSeed(seed)
+	ip.noise(background / 8.0)
+	for overlay, value in overlays:
+		ip.setValue(value)
+		for roi in overlay:
+			ip.fill(roi)
+	ip.resetMinAndMax()
+	return ip
+
+def blobImage(overlays, width, height, background, sigma, seed):
+	"""16-bit image of gaussian blobs: overlays is a list of (overlay, value) pairs painted in order and then blurred with sigma (in pixels),
+	before noise is added to everything"""
+	ip = ShortProcessor(width, height)
+	ip.setValue(background)
+	ip.fill()
+	for overlay, value in overlays:
+		ip.setValue(value)
+		for roi in overlay:
+			ip.fill(roi)
+	GaussianBlur().blurGaussian(ip, sigma)
+	ImageProcessor.setRandomSeed(seed)
+	ip.noise(background / 8.0)
+	ip.resetMinAndMax()
+	return ip
@@ -0,0 +1,98 @@
+#### check of tiled processing (F2H_processing.tilePairs with mosaicLevels) against processing the same mosaic whole
+### a synthetic nuclear/bait mosaic is split into tiles of each size, read tile by tile from memory as tileProcessor reads them
+### from the file; the pairs found must not depend on the tile size, and up to 4096 pixels a side (where the levels are taken
+### at full resolution) must be identical to those of the whole mosaic. Larger mosaics report how many pairs the tiles share with it
+
+#@ File (label="ImageJ-plugins directory", style="directory") repoDir
+#@ String (label="mosaic sizes (pixels)", value="3072,6144") mosaicSizes
+#@ String (label="tile sizes (pixels)", value="1024,1536") tileSizes
+#@ Integer (label="tile overlap (pixels)", value=200, min=0) overlap
+
+import sys
+sys.path.append(repoDir.getAbsolutePath())
+sys.path.append(repoDir.getAbsolutePath() + "/benchmarks")
+sys.path.append(repoDir.getAbsolutePath() + "/jars/Lib")
+
+from ij import ImagePlus, ImageStack
+from ij.gui import Overlay
+from java.awt import Rectangle
+from java.lang import System
+
+import F2H_processing
+import synthetic
+
+parameters = {'lower nuclear area': 1000, 'upper nuclear area': 20000, 'lower array area': 5, 'upper array area': 200,
+	'lower threshold': 50, 'upper threshold': 255}
+slices = {'nuclear': 1, 'bait': 2}
+
+def timed(function, *args):
+	start = System.nanoTime()
+	result = function(*args)
+	return (System.nanoTime() - start) / 1e6, result
+
+def outlines(overlay):
+	"""outline of every nucleus, array and nucleoplasm roi, in mosaic coordinates and in no particular order"""
+	return sorted(tuple(overlay.get(i).getPolygon().xpoints) + tuple(overlay.get(i).getPolygon().ypoints) for i in range(Overlay.size(overlay)))
+
+def whole(imp):
+	"""pairs of the mosaic processed as one image, as imageProcessor does"""
+	images = {'nuclear': ImagePlus('nuclear', imp.getImageStack().getProcessor(slices['nuclear'])).duplicate(),
+		'bait': ImagePlus('bait', imp.getImageStack().getProcessor(slices['bait'])).duplicate()}
+	DAPIoverlay = F2H_processing.findnucleus(images['nuclear'], parameters)
+	if not DAPIoverlay:
+		return Overlay()
+	totalnuclei = Overlay.size(DAPIoverlay)
+	baitoverlay = F2H_processing.findarray(images, DAPIoverlay, totalnuclei, parameters)
+	if not baitoverlay:
+		return Overlay()
+	DAPIoverlay, totalnuclei = F2H_processing.nucFilter(DAPIoverlay, baitoverlay, Overlay.size(baitoverlay), totalnuclei)
+	return F2H_processing.nucArraypairer(DAPIoverlay, baitoverlay, Overlay.size(baitoverlay), totalnuclei)
+
+def tiled(imp, size):
+	"""pairs of the mosaic processed as tiles of size pixels, as tileProcessor does"""
+	stack = imp.getImageStack()
+	opener = lambda rect: ImagePlus("tile", stack.crop(rect.x, rect.y, 0, rect.width, rect.height, stack.getSize()))
+	mosaic = Rectangle(imp.getWidth(), imp.getHeight())
+	tiles = []
+	for y in range(0, mosaic.height, size):
+		for x in range(0, mosaic.width, size):
+			tiles.append((Rectangle(x, y, size, size).intersection(mosaic), Rectangle(x - overlap, y - overlap, size + 2 * overlap, size + 2 * overlap).intersection(mosaic)))
+	levels = F2H_processing.mosaicLevels([tile[0] for tile in tiles], opener, mosaic, slices)
+	finalOverlay = Overlay()
+	if levels is None:
+		return finalOverlay
+	profile = F2H_processing.stageProfile()
+	for core, region in tiles:
+		pairs = F2H_processing.tilePairs(opener(region), core, region, slices, parameters, levels, profile, "tile")
+		for i in range(Overlay.size(pairs)):
+			roi = pairs.get(i)
+			roi.setLocation(roi.getXBase() + region.x, roi.getYBase() + region.y)
+			finalOverlay.add(roi)
+	return finalOverlay
+
+failed = []
+for size in [int(i) for i in mosaicSizes.split(",")]:
+	count = int(40 * size * size / 1e6)
+	nuclei = synthetic.ovalOverlay(count, size, size, 60, 140, size)
+	arrays = synthetic.arrayOverlay(nuclei, 2 * count, size, size, 3, 14, size + 1)
+	stack = ImageStack(size, size)
+	stack.addSlice("c:1", synthetic.blobImage([(nuclei, 3000)], size, size, 200, 2, size + 2))
+	stack.addSlice("c:2", synthetic.blobImage([(arrays, 2000)], size, size, 200, 1, size + 3))
+	imp = ImagePlus("mosaic", stack)
+	wholeTime, reference = timed(whole, imp)
+	reference = outlines(reference)
+	print "{0} px whole: {1} pairs in {2:.0f} ms".format(size, len(reference) // 3, wholeTime)
+	first = None
+	for tileSize in [int(i) for i in tileSizes.split(",")]:
+		time, pairs = timed(tiled, imp, tileSize)
+		pairs = outlines(pairs)
+		shared = len(set(pairs) & set(reference))
+		print "{0} px in {1} px tiles: {2} pairs in {3:.0f} ms, {4} of {5} rois as in the whole mosaic".format(size, tileSize, len(pairs) // 3, time, shared, len(reference))
+		if first is not None and pairs != first:
+			failed.append("{0} px: tiles of {1} px and {2} px give different pairs".format(size, tileSizes.split(",")[0], tileSize))
+		if size <= 4096 and pairs != reference:
+			failed.append("{0} px: tiles of {1} px differ from the whole mosaic".format(size, tileSize))
+		first = pairs if first is None else first
+	imp.flush()
+assert failed == [], "; ".join(failed)
+print "tiled and whole mosaic calls agree"
@@ -0,0 +1,65 @@
+#### benchmark of the label image and ShapeRoi union paths for blanking the background around many rois
+### F2H_processing.findarray blanks everything outside the nuclei, subcell_loc.imageProperties.overlayMaker everything outside the cells.
+### both are run with each method on the same synthetic frames at increasing particle counts; the blanked images and the
+### cell masks must be identical before the timings are reported
+
+#@ File (label="ImageJ-plugins directory", style="directory") repoDir
+#@ String (label="particle counts", value="10,100,1000") particleCounts
+
+import sys
+sys.path.append(repoDir.getAbsolutePath())
+sys.path.append(repoDir.getAbsolutePath() + "/benchmarks")
+sys.path.append(repoDir.getAbsolutePath() + "/jars/Lib")
+
+from ij import ImagePlus
+from ij.gui import Overlay
+from java.lang import System
+from java.util import Arrays
+
+import F2H_processing
+import subcell_loc
+import synthetic
+
+parameters = {'lower threshold': 50, 'upper threshold': 255, 'lower array area': 5, 'upper array area': 200}
+
+def timeFindarray(nuclei, arrays, bait, method):
+	images = {'bait': ImagePlus('bait', bait.duplicate())}
+	start = System.nanoTime()
+	baitoverlay = F2H_processing.findarray(images, nuclei, nuclei.size(), parameters, method)
+	return (System.nanoTime() - start) / 1e6, Overlay.size(baitoverlay) if baitoverlay else 0, images['bait'].getProcessor().getPixels()
+
+def timeOverlayMaker(cells, nuclear, width, height, method):
+	"""overlayMaker with the manual cell drawing replaced by a ready made overlay"""
+	properties = subcell_loc.imageProperties("manual")
+	properties.imageLabels = {'snapName': 'synthetic', 'snapNo': '1'}
+	properties.images = {'cell': ImagePlus('cell', nuclear.duplicate()), 'DAPI': ImagePlus('DAPI', nuclear.duplicate())}
+	properties.images['cell'].setOverlay(cells.duplicate())
+	properties.itemID = lambda imp, item, shape: None
+	start = System.nanoTime()
+	cellMask, cellCount, nucleiCount = properties.overlayMaker('cell', 'DAPI', width, height, method)
+	return (System.nanoTime() - start) / 1e6, nucleiCount, cellMask.getPixels(), properties.images['DAPI'].getProcessor().getPixels()
+
+failed = []
+for count in [int(i) for i in particleCounts.split(",")]:
+	size = int((count * 150 * 150) ** 0.5) + 200
+	nuclei = synthetic.ovalOverlay(count, size, size, 60, 140, count)
+	arrays = synthetic.arrayOverlay(nuclei, 2 * count, size, size, 3, 14, count + 1)
+	bait = synthetic.paintedImage([(arrays, 2000)], size, size, 200, count + 2)
+	shapeTime, shapeArrays, shapePixels = timeFindarray(nuclei, arrays, bait, "shape")
+	labelTime, labelArrays, labelPixels = timeFindarray(nuclei, arrays, bait, "label")
+	if not Arrays.equals(shapePixels, labelPixels):
+		failed.append("findarray, {0} nuclei: shape and label blank different pixels".format(count))
+		print failed[-1]
+	else:
+		print "findarray, {0} nuclei: shape {1:.0f} ms ({2} arrays), label {3:.0f} ms ({4} arrays)".format(count, shapeTime, shapeArrays, labelTime, labelArrays)
+	cells = synthetic.ovalOverlay(count, size, size, 120, 220, count + 3)
+	nuclear = synthetic.paintedImage([(nuclei, 3000)], size, size, 200, count + 4)
+	shapeTime, shapeNuclei, shapeMask, shapePixels = timeOverlayMaker(cells, nuclear, size, size, "shape")
+	labelTime, labelNuclei, labelMask, labelPixels = timeOverlayMaker(cells, nuclear, size, size, "label")
+	if not Arrays.equals(shapeMask, labelMask) or not Arrays.equals(shapePixels, labelPixels):
+		failed.append("overlayMaker, {0} cells: shape and label give different cell masks".format(count))
+		print failed[-1]
+	else:
+		print "overlayMaker, {0} cells: shape {1:.0f} ms ({2} nuclei), label {3:.0f} ms ({4} nuclei)".format(count, shapeTime, shapeNuclei, labelTime, labelNuclei)
+assert failed == [], "; ".join(failed)
+print "shape and label results identical"
@@ -0,0 +1,453 @@
+#### helpers shared by F2H_processing.py and subcell_loc.py: czi reading, result caching and csv writing, roi masks and
+### statistics, output paths and stage timing. Fiji scripts import it from Fiji.app/jars/Lib, where it has to be copied
+
+from ij import IJ, ImagePlus, ImageStack
+from ij.process import ImageStatistics as IS
+from ij.process import Blitter, ByteProcessor, ShortProcessor, ImageProcessor
+from ij.io import FileSaver, RoiDecoder, RoiEncoder
+from ij.plugin.filter import ParticleAnalyzer
+from ij.measure import ResultsTable, Calibration, Measurements
+from ij.gui import Overlay
+
+from loci.formats import Memoizer, MetadataTools
+from loci.formats.in import ZeissCZIReader, DynamicMetadataOptions
+from loci.plugins.util import ImageProcessorReader
+from ome.units import UNITS
+
+import csv
+import hashlib
+import json
+import threading
+
+from java.awt import Rectangle
+from java.io import BufferedOutputStream, ByteArrayOutputStream, DataOutputStream, File, FileInputStream, FileOutputStream, IOException
+from java.lang import System, Runtime
+from java.nio.file import Files, Paths, StandardCopyOption
+from java.security import MessageDigest
+from java.util import Collections
+from java.util.zip import ZipEntry, ZipFile, ZipOutputStream
+from jarray import zeros
+
+#output paths handed out by uniquePath in this run, by any script
+claimedPaths = set()
+claimLock = threading.Lock()
+
+class cziAccess:
+	"""one memoised Bio-Formats reader per czi file, used for both its metadata and its planes"""
+	memoDir = System.getProperty("java.io.tmpdir") + System.getProperty("file.separator") + "bfmemo"
+
+	def __init__(self, imagefile, autostitch = False):
+		"""with autostitch the tiles of each scene are read as one stitched mosaic"""
+		self.imagefile = imagefile
+		options = DynamicMetadataOptions()
+		options.setBoolean("zeissczi.autostitch", autostitch)
+		options.setBoolean("zeissczi.attachments", False)
+		czireader = ZeissCZIReader()
+		czireader.setFlattenedResolutions(False)
+		czireader.setMetadataOptions(options)
+		memoDir = self.memoDir + (System.getProperty("file.separator") + "stitched" if autostitch else "")
+		File(memoDir).mkdirs()
+		self.meta = MetadataTools.createOMEXMLMetadata()
+		self.reader = ImageProcessorReader(Memoizer(czireader, 0, File(memoDir)))
+		self.reader.setMetadataStore(self.meta)
+		self.reader.setId(imagefile)
+
+	def info(self):
+		"""image dimensions and series length"""
+		CZIinfo = {}
+		self.reader.setSeries(0)
+		CZIinfo['seriesCount'] = self.reader.getSeriesCount()
+		CZIinfo['SizeC'] = self.reader.getSizeC()
+		CZIinfo['SizeX'] = self.reader.getSizeX()
+		CZIinfo['SizeY'] = self.reader.getSizeY()
+		return CZIinfo
+
+	def title(self, series):
+		"""image title as given by the Bio-Formats importer, i.e. the file name followed by the scene name for multi-scene files"""
+		title = File(self.imagefile).getName()
+		if self.reader.getSeriesCount() > 1:
+			seriesName = self.meta.getImageName(series)
+			if seriesName:
+				title += " - " + seriesName
+			else:
+				title += " #" + str(series + 1)
+		return title
+
+	def calibration(self, series):
+		cal = Calibration()
+		sizeX, sizeY = self.meta.getPixelsPhysicalSizeX(series), self.meta.getPixelsPhysicalSizeY(series)
+		if sizeX is not None and sizeY is not None:
+			cal.pixelWidth = sizeX.value(UNITS.MICROMETER).doubleValue()
+			cal.pixelHeight = sizeY.value(UNITS.MICROMETER).doubleValue()
+			cal.setUnit("micron")
+		return cal
+
+	def openImage(self, series = 0, channels = None, region = None):
+		"""open the given channels (by default all) of one series, or of region of it, as a calibrated hyperstack"""
+		self.reader.setSeries(series)
+		if channels is None:
+			channels = range(1, self.reader.getEffectiveSizeC() + 1)
+		if region is None:
+			region = Rectangle(self.reader.getSizeX(), self.reader.getSizeY())
+		sizeZ, sizeT = self.reader.getSizeZ(), self.reader.getSizeT()
+		stack = ImageStack(region.width, region.height)
+		for t in range(sizeT):
+			for z in range(sizeZ):
+				for c in channels:
+					ip = self.reader.openProcessors(self.reader.getIndex(z, c - 1, t), region.x, region.y, region.width, region.height)[0]
+					stack.addSlice("c:" + str(c), ip)
+		imp = ImagePlus(self.title(series), stack)
+		imp.setDimensions(len(channels), sizeZ, sizeT)
+		imp.setCalibration(self.calibration(series))
+		return imp
+
+	def close(self):
+		self.reader.close()
+
+class imageLog:
+	"""log kept per image so images processed in parallel do not interleave their messages in the saved log"""
+	def __init__(self):
+		self.lines = []
+		self.roiFile = None #roi zip saved for the image, recorded in the manifest
+
+	def log(self, message):
+		self.lines.append(message)
+		IJ.log(message)
+
+	def extend(self, other):
+		self.lines += other.lines
+
+	def getText(self):
+		return "\n".join(self.lines) + "\n"
+
+class resultCache:
+	"""least recently used on-disk cache of intermediate results, keyed by a hash of the input file and parameters"""
+	def __init__(self, directory, sizeLimit):
+		self.directory = directory
+		self.sizeLimit = sizeLimit
+		self.lock = threading.Lock()
+		if directory is not None:
+			File(directory, "hashes").mkdirs()
+
+	def fileHash(self, imagefile):
+		"""sha1 of the file content. Remembered per path, size and modification time so each file is only read once"""
+		if self.directory is None:
+			return None
+		image = File(imagefile)
+		stamp = {'path': imagefile, 'size': image.length(), 'mtime': image.lastModified()}
+		memo = File(File(self.directory, "hashes"), hashlib.md5(imagefile.encode("utf-8")).hexdigest() + ".json")
+		try:
+			with open(memo.getPath()) as memoFile:
+				remembered = json.load(memoFile)
+			if remembered['stamp'] == stamp:
+				return remembered['sha1']
+		except (IOError, ValueError, KeyError):
+			pass
+		digest = MessageDigest.getInstance("SHA-1")
+		stream = FileInputStream(image)
+		buffer = zeros(1 << 20, 'b')
+		length = stream.read(buffer)
+		while length > 0:
+			digest.update(buffer, 0, length)
+			length = stream.read(buffer)
+		stream.close()
+		sha1 = "".join("%02x" % (b & 0xff) for b in digest.digest())
+		with open(memo.getPath(), 'w') as memoFile:
+			json.dump({'stamp': stamp, 'sha1': sha1}, memoFile)
+		return sha1
+
+	def key(self, *parts):
+		return hashlib.sha1("|".join(str(part) for part in parts)).hexdigest()
+
+	def entry(self, key, extension):
+		entry = File(self.directory, key + extension)
+		if not entry.exists():
+			return None
+		entry.setLastModified(System.currentTimeMillis())
+		return entry
+
+	def image(self, key, compute):
+		"""cached ImagePlus for key; on a miss compute() is called and its image stored"""
+		if self.directory is None:
+			return compute()
+		entry = self.entry(key, ".tif")
+		imp = IJ.openImage(entry.getPath()) if entry else None
+		if imp is None:
+			imp = compute()
+			temp = File(self.directory, key + ".part.tif").getPath()
+			if imp.getStackSize() > 1:
+				FileSaver(imp).saveAsTiffStack(temp)
+			else:
+				FileSaver(imp).saveAsTiff(temp)
+			self.store(temp, key + ".tif")
+		return imp
+
+	def rois(self, key, compute):
+		"""cached overlay for key; on a miss compute() is called and its overlay (or None) stored"""
+		if self.directory is None:
+			return compute()
+		entry = self.entry(key, ".zip")
+		if entry:
+			try:
+				overlay = roiZipReader(entry.getPath())
+				return overlay if Overlay.size(overlay) > 0 else None
+			except IOException: #evicted by another run while reading
+				pass
+		overlay = compute()
+		temp = File(self.directory, key + ".part.zip").getPath()
+		roiZipWriter(overlay if overlay else Overlay(), temp)
+		self.store(temp, key + ".zip")
+		return overlay
+
+	def store(self, temp, name):
+		atomicMove(temp, File(self.directory, name).getPath())
+		with self.lock:
+			entries = [entry for entry in File(self.directory).listFiles() if entry.isFile() and ".part." not in entry.getName()]
+			total = sum(entry.length() for entry in entries)
+			for entry in sorted(entries, key = lambda entry: entry.lastModified()):
+				if total <= self.sizeLimit:
+					break
+				total -= entry.length()
+				entry.delete()
+
+class resultsWriter:
+	"""stream measurement rows to a csv with fixed columns, moved into place by close()"""
+	def __init__(self, filepath, columns):
+		self.filepath = filepath
+		self.temp = filepath + ".part"
+		self.rows = 0
+		self.stream = open(self.temp, 'wb')
+		self.writer = csv.writer(self.stream)
+		self.writer.writerow(columns)
+
+	def write(self, rows):
+		for row in rows:
+			self.writer.writerow([self.format(value) for value in row])
+			self.rows += 1
+		self.stream.flush()
+
+	def format(self, value):
+		"""numbers as the ResultsTable saves them: whole numbers without decimals, others to 3 decimal places"""
+		if not isinstance(value, float):
+			return unicode(value).encode("utf-8")
+		if value == round(value) and abs(value) < 1e9:
+			return "%d" % value
+		return ResultsTable.d2s(value, 3)
+
+	def close(self):
+		"""path of the finished csv, or None if no rows were written"""
+		self.stream.close()
+		if self.rows == 0:
+			File(self.temp).delete()
+			return None
+		atomicMove(self.temp, self.filepath)
+		return self.filepath
+
+	def abort(self):
+		self.stream.close()
+		File(self.temp).delete()
+
+class roiIndex:
+	"""uniform grid over roi bounding boxes, used to find the rois that can overlap a given rectangle without testing every roi"""
+	def __init__(self, masks, cellSize = 64):
+		self.cellSize = cellSize
+		self.grid = {}
+		for index, (bounds, mask) in enumerate(masks):
+			for cell in self.cells(bounds):
+				self.grid.setdefault(cell, []).append(index)
+
+	def cells(self, bounds):
+		size = self.cellSize
+		xRange = range(bounds.x // size, (bounds.x + bounds.width - 1) // size + 1)
+		yRange = range(bounds.y // size, (bounds.y + bounds.height - 1) // size + 1)
+		return [(x, y) for x in xRange for y in yRange]
+
+	def candidates(self, bounds):
+		"""indices of all rois whose bounding box shares a grid cell with bounds, in ascending order"""
+		found = set()
+		for cell in self.cells(bounds):
+			found.update(self.grid.get(cell, []))
+		return sorted(found)
+
+class stageProfile:
+	"""wall time, roi count and heap in use after each pipeline stage of each image, shared by all worker threads of a run"""
+	columns = ["Image", "Stage", "Milliseconds", "Count", "Heap MB"]
+
+	def __init__(self):
+		self.records = []
+		self.lock = threading.Lock()
+
+	def time(self, image, stage):
+		return stageTimer(self, image, stage)
+
+	def add(self, record):
+		with self.lock:
+			self.records.append(record)
+
+	def save(self, filepath):
+		"""write the records as csv; returns the path, or None if nothing was timed"""
+		writer = resultsWriter(filepath, self.columns)
+		writer.write(self.records)
+		return writer.close()
+
+	def summary(self, count = 5):
+		"""lines giving the total time of each stage, slowest first, and the count slowest images"""
+		stages, images = {}, {}
+		for image, stage, milliseconds, rois, heap in self.records:
+			if stage == "total":
+				images[image] = images.get(image, 0) + milliseconds
+			else:
+				stages[stage] = stages.get(stage, 0) + milliseconds
+		slowest = lambda times: sorted(times.items(), key = lambda item: -item[1])
+		lines = ["time per stage: " + ", ".join("{0} {1:.1f} s".format(stage, milliseconds / 1000) for stage, milliseconds in slowest(stages))]
+		lines.append("slowest images: " + ", ".join("{0} {1:.1f} s".format(File(image).getName(), milliseconds / 1000) for image, milliseconds in slowest(images)[:count]))
+		return lines
+
+class stageTimer:
+	"""context manager timing one stage of one image for stageProfile"""
+	def __init__(self, profile, image, stage):
+		self.profile = profile
+		self.image = image
+		self.stage = stage
+		self.count = ""
+
+	def __enter__(self):
+		self.start = System.nanoTime()
+		return self
+
+	def __exit__(self, *exception):
+		milliseconds = (System.nanoTime() - self.start) / 1e6
+		runtime = Runtime.getRuntime()
+		heap = (runtime.totalMemory() - runtime.freeMemory()) / 1048576.0
+		self.profile.add([self.image, self.stage, milliseconds, self.count, heap])
+		return False
+
+def analyzeParticles(imp, lower, upper, circularity):
+	"""equivalent of Analyze Particles... show=Overlay include, but with a private results table so it is safe to run on several images at once"""
+	options = ParticleAnalyzer.SHOW_OVERLAY_OUTLINES | ParticleAnalyzer.INCLUDE_HOLES
+	pa = ParticleAnalyzer(options, 0, ResultsTable(), lower, upper, circularity, 1.0)
+	pa.setHideOutputImage(True)
+	pa.analyze(imp)
+	return imp.getOverlay()
+
+def atomicMove(temp, filepath):
+	Files.move(Paths.get(temp), Paths.get(filepath), StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE)
+
+def backgroundMask(labels):
+	"""mask (255) of all pixels of a label image not covered by any roi"""
+	labels.setThreshold(0, 0, ImageProcessor.NO_LUT_UPDATE)
+	mask = labels.createMask()
+	labels.resetThreshold()
+	return mask
+
+def getCZIinfo(imagefile):
+	"""import czi info incl. image dimensions and series length"""
+	czi = cziAccess(imagefile)
+	CZIinfo = czi.info()
+	czi.close()
+	return CZIinfo
+
+def labelImage(overlay, width, height):
+	"""paint every roi of the overlay into a 16-bit image with the value (overlay index + 1); 0 is background"""
+	labels = ShortProcessor(width, height)
+	for i in range(Overlay.size(overlay)):
+		labels.setValue(i + 1)
+		labels.fill(overlay.get(i))
+	return labels
+
+def overlapArea(first, second):
+	"""number of pixels contained in both of two rois given as (bounds, mask) pairs from roiMask"""
+	bounds = first[0].intersection(second[0])
+	if bounds.isEmpty():
+		return 0
+	overlap = None
+	for roiBounds, mask in [first, second]:
+		mask.setRoi(bounds.x - roiBounds.x, bounds.y - roiBounds.y, bounds.width, bounds.height)
+		crop = mask.crop()
+		mask.resetRoi()
+		if overlap is None:
+			overlap = crop
+		else:
+			overlap.copyBits(crop, 0, 0, Blitter.AND)
+	return overlap.getHistogram()[255]
+
+def resultsSaver(item, output, name, extension, log = IJ.log):
+	"""save log files"""
+	filepath = uniquePath(output, name, extension)
+	if extension == ".txt":
+		with open(filepath, 'w') as logSaver:
+			logSaver.write(item)
+	log("Output saved to {0}".format(filepath))
+
+def roiMask(roi):
+	"""bounding box and mask of a roi; the mask is set (255) at exactly the roi's contained points"""
+	bounds = roi.getBounds()
+	mask = roi.getMask()
+	if mask is None:
+		mask = ByteProcessor(bounds.width, bounds.height)
+		mask.setColor(255)
+		mask.fill()
+	return bounds, mask
+
+def roiStatistics(imp, overlay, channels):
+	"""yield (label, roi index, statistics) of every roi of overlay in each (label, slice) of channels"""
+	stack = imp.getImageStack()
+	calibration = imp.getCalibration()
+	measurements = Measurements.AREA | Measurements.MEAN | Measurements.MEDIAN
+	imageBounds = Rectangle(imp.getWidth(), imp.getHeight())
+	masks = [roiMask(overlay.get(i)) for i in range(Overlay.size(overlay))]
+	for label, channel in channels:
+		ip = stack.getProcessor(channel)
+		for i, (bounds, mask) in enumerate(masks):
+			if imageBounds.contains(bounds):
+				ip.setRoi(bounds)
+				ip.setMask(mask)
+			else: #let ImageJ clip rois that reach outside the image, as roi.getStatistics() does
+				ip.setRoi(overlay.get(i))
+			yield label, i, IS.getStatistics(ip, measurements, calibration)
+		ip.resetRoi()
+
+def roiZipReader(filepath, prefix = ""):
+	"""read the rois of a zip written by roiZipWriter into an overlay, only those under prefix if given"""
+	overlay = Overlay()
+	archive = ZipFile(filepath)
+	try:
+		for entry in Collections.list(archive.entries()):
+			if not entry.getName().startswith(prefix):
+				continue
+			stream = archive.getInputStream(entry)
+			data = ByteArrayOutputStream()
+			buffer = zeros(8192, 'b')
+			length = stream.read(buffer)
+			while length > 0:
+				data.write(buffer, 0, length)
+				length = stream.read(buffer)
+			stream.close()
+			overlay.add(RoiDecoder(data.toByteArray(), entry.getName()).getRoi())
+	finally:
+		archive.close()
+	return overlay
+
+def roiZipWriter(overlay, filepath):
+	"""save the rois of an overlay to a zip that the RoiManager can open, without going through the RoiManager"""
+	zipStream = ZipOutputStream(BufferedOutputStream(FileOutputStream(filepath)))
+	out = DataOutputStream(zipStream)
+	encoder = RoiEncoder(out)
+	for i in range(Overlay.size(overlay)):
+		roi = overlay.get(i)
+		name = roi.getName() if roi.getName() else "%04d" % (i + 1)
+		zipStream.putNextEntry(ZipEntry(name + ".roi"))
+		encoder.write(roi)
+		out.flush()
+	out.close()
+
+def uniquePath(output, name, extension):
+	"""first of name.ext, name1.ext, name2.ext... not yet in output nor handed out in this run"""
+	with claimLock:
+		filepath = output + name + extension
+		level = 0
+		while File(filepath).exists() or filepath in claimedPaths:
+			level += 1
+			filepath = output + name + str(level) + extension
+		claimedPaths.add(filepath)
+	return filepath
@@ -2,46 +2,109 @@
 #2. measures intensity and area of cells, nuclei, and cytosol in the channels of interest
 #3. outputs measurements as a csv file
 
-#@ File (label="Select the input file", description="input .czi file location") imagefile
+#@ File[] (label="Select the input files or directories", description="czi files, or directories of czi files, to process as one batch", style="both") inputFiles
+#@ File (label="Cache directory (optional)", style="directory", required=false) cacheDir
+#@ Integer (label="Cache size limit (GB)", value=20, min=1) cacheLimit
+#@ Boolean (label="Show results table when finished", value=false) showResults
+#@ String (label="Cell segmentation", choices={"manual", "review", "automatic"}, style="listBox", value="automatic") segmentation
+#@ Integer (label="Parallel scenes (automatic segmentation only)", value=1, min=1) parallelScenes
 
 from ij import IJ, ImagePlus, Prefs, WindowManager
 from ij.process import ImageStatistics as IS
+from ij.process import Blitter, ByteProcessor, ImageProcessor, AutoThresholder
+from ij.plugin.filter import EDM, GaussianBlur, LutApplier, MaximumFinder
 from ij.plugin.frame import RoiManager
 from ij.measure import ResultsTable
 from ij.gui import Overlay, Roi, ShapeRoi, WaitForUserDialog, GenericDialog
 # read in and display ImagePlus object(s)
-from loci.plugins import BF
 from loci.common import Region
-from loci.plugins.in import ImporterOptions
 from loci.plugins.util import LociPrefs
-from loci.formats import ImageReader, MetadataTools
-# ZEISS STUFF
-from loci.formats.in import ZeissCZIReader, DynamicMetadataOptions
+from loci.formats import ImageReader
 #regular expressions
 import re
 #saving
 from os import path
 
 import sys
-import collections
 
 #file management
 from java.io import File
-from java.lang import System
+from java.lang import System, Runtime
 from java.text import SimpleDateFormat
 
+#parallel processing
+from java.util.concurrent import Callable, Executors
+
 #detect if run via Gui
-from java.awt import GraphicsEnvironment
+from java.awt import GraphicsEnvironment, Rectangle
+
+#helpers shared with F2H_processing.py, from Fiji.app/jars/Lib/plugin_common.py
+from plugin_common import analyzeParticles, backgroundMask, cziAccess, getCZIinfo, imageLog, labelImage, overlapArea, resultCache, \
+	resultsSaver, resultsWriter, roiIndex, roiMask, roiStatistics, stageProfile, uniquePath
+
+resultColumns = ["Name", "snapNo", "Channel", "ROI", "Area", "Mean", "Median"]
+
+class frameTask(Callable):
+	"""process one frame of a czi file with its own reader, ImagePlus and log, so frames can run on worker threads; returns the frame's rows"""
+	def __init__(self, imagefile, frame, frameCount, channelList, frameChannels, cache, fileHash, segmentation, profile):
+		self.imagefile = imagefile
+		self.profile = profile
+		self.frame = frame
+		self.frameCount = frameCount
+		self.channelList = channelList
+		self.frameChannels = frameChannels
+		self.cache = cache
+		self.fileHash = fileHash
+		self.segmentation = segmentation
+		self.log = imageLog()
 
+	def call(self):
+		image = "{0} #{1}".format(self.imagefile, self.frame + 1)
+		with self.profile.time(image, "total"):
+			with self.profile.time(image, "open"):
+				czi = cziAccess(self.imagefile)
+				try:
+					imp = self.cache.image(self.cache.key(self.fileHash, self.frame, self.channelList), lambda: czi.openImage(self.frame, self.channelList))
+					imp.setTitle(czi.title(self.frame))
+				finally:
+					czi.close()
+			table = imageProperties(self.segmentation, self.log, self.profile, image).imageProcessor(imp, imp.getWidth(), imp.getHeight(), self.frameChannels)
+		imp.flush()
+		self.log.log("finished processing {0} out of {1} frames.".format(self.frame + 1, self.frameCount))
+		return table
+
+def assignPairs(overlaps):
+	"""resolve cell-nucleus pairs from {(cell index, nucleus index): overlap area}; returns them in cell order"""
+	cellDegree, nucleusDegree = {}, {}
+	for cell, nucleus in overlaps:
+		cellDegree[cell] = cellDegree.get(cell, 0) + 1
+		nucleusDegree[nucleus] = nucleusDegree.get(nucleus, 0) + 1
+	def rank(pair):
+		unique = cellDegree[pair[0]] == 1 or nucleusDegree[pair[1]] == 1
+		return (not unique, -overlaps[pair], pair[0], pair[1])
+	pairs, cells, nuclei = [], set(), set()
+	for cell, nucleus in sorted(overlaps, key = rank):
+		if cell in cells or nucleus in nuclei:
+			continue
+		pairs.append((cell, nucleus))
+		cells.add(cell)
+		nuclei.add(nucleus)
+	return sorted(pairs)
 
-def binarize(imp, channel):
+def binarize(imp, channel, native = True):
 	"""convert image plus to binary imp"""
 	ip = imp.getProcessor()
 	stats = IS.getStatistics(ip, IS.MIN_MAX, imp.getCalibration())
 	maxVal = stats.max
 	imp.setDisplayRange(450, maxVal)
-	IJ.run(imp, "Apply LUT", "")
-	IJ.run(imp, "Gaussian Blur...", "sigma=1")
+	if native:
+		applier = LutApplier()
+		applier.setup("", imp)
+		applier.run(imp.getProcessor())
+		GaussianBlur().blurGaussian(imp.getProcessor(), 1)
+	else:
+		IJ.run(imp, "Apply LUT", "")
+		IJ.run(imp, "Gaussian Blur...", "sigma=1")
 	IJ.run(imp, "Make Binary", "BlackBackground")
 	return imp
 
@@ -61,7 +124,7 @@ def channelSelector(channelCount, channelIDs = None):
 		channelIDs = [gd.getNextString() for i in range(3)]
 		proteinsOfinterest = str(channelIDs.pop()).split(",")
 		channelIDs += proteinsOfinterest
-		channelDict = {}
+	channelDict = {}
 	idList = ['nucleus', 'cell'] + [i for i in range(len(channelIDs) - 2)]
 	while channelIDs:
 		val = idList.pop()
@@ -81,111 +144,187 @@ def channelSelector(channelCount, channelIDs = None):
 	#print channelDict
 	return channelDict
 
-def getCZIinfo(imagefile):
-	"""import czi info incl. image dimensions and series length"""
-	CZIinfo = {}
-	options = DynamicMetadataOptions()
-	options.setBoolean("zeissczi.autostitch", False)
-	options.setBoolean("zeissczi.attachments", False)
-	czireader = ZeissCZIReader()
-	czireader.setFlattenedResolutions(False)
-	czireader.setMetadataOptions(options)
-	czireader.setId(imagefile)
-	CZIinfo['seriesCount'] = czireader.getSeriesCount()
-	CZIinfo['SizeC'] = czireader.getSizeC()
-	CZIinfo['SizeX'] = czireader.getSizeX()
-	CZIinfo['SizeY'] = czireader.getSizeY()
-	czireader.close()
-	#print "CZIinfo generated"
-	return CZIinfo
-
-def imageOpener(imagefile):
-	# Set the preferences in the ImageJ plugin
-	Prefs.set("bioformats.zeissczi.allow.autostitch", str(False).lower())
-	Prefs.set("bioformats.zeissczi.include.attachments", str(True).lower())
-	# read in and display ImagePlus(es) with arguments
-	options = ImporterOptions()
-	options.setOpenAllSeries(True)
-	options.setConcatenate(False)
-	options.setId(imagefile)
-	imps = BF.openImagePlus(options)
-	return imps
+def fileFinder(inputFiles):
+	"""czi files among the selected files and in the selected directories, in the order given"""
+	cziFinder = re.compile(".*czi$")
+	pathList = []
+	for selected in inputFiles:
+		if selected.isDirectory():
+			pathList += sorted(image.getAbsolutePath() for image in selected.listFiles() if cziFinder.match(image.getName()))
+		elif cziFinder.match(selected.getName()):
+			pathList.append(selected.getAbsolutePath())
+	return pathList
 
-def processimagefile(imagefile):
-	"""function to take in input file and process it. Runs the other functions in this plugin."""
+def processBatch(inputFiles, cacheDir = None, cacheLimit = 20, showResults = False, segmentation = "automatic", parallelScenes = 1):
+	"""process all czi files given directly or found in the given directories as one batch"""
+	if segmentation != "automatic" and GraphicsEnvironment.isHeadless():
+		IJ.log("{0} cell segmentation needs a display; use automatic segmentation for headless runs. Exiting".format(segmentation))
+		return
+	pathList = fileFinder(inputFiles if inputFiles else [])
+	if pathList == []:
+		IJ.log("No .czi files selected. Exiting")
+		IJ.error("No .czi files selected. Exiting")
+		return
 	sep = System.getProperty("file.separator")
-	output = imagefile.getParent() + sep
-	imagefile = str(imagefile)
-	splitFile = imagefile.split("/")
-	name = splitFile[-1].split(".")[0]
-	#process image metadata and open image file
-	CZIinfo = getCZIinfo(imagefile)
-	imp = imageOpener(imagefile)
-	outputArray = []
-	#If image has fewer than 2 channels exit
-	#otherwise the user identifies which channels label cellular compartments and which label proteins of interest
+	#the user identifies which channels label cellular compartments and which label proteins of interest, once for the batch
+	CZIinfo = getCZIinfo(pathList[0])
 	if CZIinfo['SizeC'] < 2:
 		IJ.log("A minimum of 2 channels is required for identification of cells and nuclei. Exiting")
 		IJ.error("A minimum of 2 channels is required for identification of cells and nuclei. Exiting")
 		return
-	else:
-		channels = channelSelector(CZIinfo['SizeC'])
+	channels = channelSelector(CZIinfo['SizeC'])
 	if not channels:
 		return
-	#loop through all frames in the image. In each frame, identify all cells and
-	#their respective nuclei and output an array containing the area and intensity of each
-	for frame in range(CZIinfo['seriesCount']):
-		outputArray.append(imageProperties().imageProcessor(imp[frame], CZIinfo['SizeX'], CZIinfo['SizeY'], channels))
-		IJ.log("finished processing {0} out of {1} frames.".format(frame + 1, CZIinfo['seriesCount']))
+	output = File(pathList[0]).getParent() + sep
+	name = File(pathList[0]).getName().split(".")[0] if len(pathList) == 1 else "subcell"
+	cache = resultCache(cacheDir.getAbsolutePath() if cacheDir else None, cacheLimit * 1024 ** 3)
+	results = resultsWriter(uniquePath(output, name + "_results", ".csv"), resultColumns)
+	runLog = imageLog()
+	profile = stageProfile()
+	try:
+		for i, imagefile in enumerate(pathList):
+			log = imageLog()
+			log.log("processing {0}. Image {1} out of {2}".format(imagefile, i + 1, len(pathList)))
+			processimagefile(imagefile, channels, cache, results, segmentation, log, profile, parallelScenes)
+			resultsSaver(log.getText(), File(imagefile).getParent() + sep, File(imagefile).getName().split(".")[0] + "_log", ".txt")
+			runLog.extend(log)
+	except:
+		results.abort()
+		raise
 	IJ.log("image processing finished")
-	log = IJ.getLog()
-	resultsSaver(log, output, name + "_log", ".txt")
-	table = resultsTablemaker(outputArray)
-	if ResultsTable.size(table) == 0:
+	for line in profile.summary():
+		runLog.log(line)
+	profilePath = profile.save(uniquePath(output, name + "_profile", ".csv"))
+	if profilePath:
+		runLog.log("stage timings saved to {0}".format(profilePath))
+	if len(pathList) > 1:
+		resultsSaver(runLog.getText(), output, name + "_log", ".txt")
+	resultsPath = results.close()
+	if resultsPath is None:
 		IJ.log("No transfected cells found. Bye.")
 		return
-	resultsSaver(table, output, name + "_results", ".csv")
+	IJ.log("Output saved to {0}".format(resultsPath))
 	WindowManager.closeAllWindows()
+	if showResults and not GraphicsEnvironment.isHeadless():
+		ResultsTable.open(resultsPath).show(name + "_results")
 
-def resultsTablemaker(outputArray):
-	"""convert flattened list to results table"""
-	IJ.log("filling results table")
-	table = ResultsTable()
-	colnames = collections.deque(["Name", "snapNo", "Channel", "ROI", "Area", "Mean", "Median"])
-	colLen = len(colnames)
-	for image in outputArray:
-		if image is None:
-			continue
-		for cell in image:
-			for i, value in enumerate(cell):
-				if i%colLen == 0:
-					table.incrementCounter()
-				col = colnames.popleft()
-				table.addValue(col, value)
-				colnames.append(col) 
-	return table
-
-def resultsSaver(item, output, name, extension):
-	"""save results table and log files"""
-	filepath = output + name + extension
-	level = 0
-	while File(filepath).exists():
-		level += 1
-		filepath = output + name + str(level) + extension
-	if extension == ".csv":
-		item.save(filepath)
-	elif extension == ".txt":
-		with open(filepath, 'w') as logSaver:
-			logSaver.write(item)
-	IJ.log("Output saved to {0}".format(filepath))
+def processimagefile(imagefile, channels, cache, results, segmentation, log, profile, workers = 1):
+	"""measure every frame of one czi file into results, in frame order"""
+	czi = cziAccess(imagefile)
+	try:
+		CZIinfo = czi.info()
+	finally:
+		czi.close()
+	if CZIinfo['SizeC'] < 2 or max(channel[1] for channel in channels.values()) > CZIinfo['SizeC']:
+		log.log("{0} has {1} channel(s), not all of the selected channels. Skipped".format(imagefile, CZIinfo['SizeC']))
+		return
+	#only the selected channels are read, one frame at a time, so memory is bounded by a single scene per worker.
+	#frameChannels gives the position of each selected channel in the stacks that are read
+	channelList = sorted(set([channel[1] for channel in channels.values()]))
+	frameChannels = dict((key, [value[0], channelList.index(value[1]) + 1]) for key, value in channels.items())
+	#loop through all frames in the image. In each frame, identify all cells and
+	#their respective nuclei and output an array containing the area and intensity of each
+	fileHash = cache.fileHash(imagefile)
+	frameCount = CZIinfo['seriesCount']
+	tasks = [frameTask(imagefile, frame, frameCount, channelList, frameChannels, cache, fileHash, segmentation, profile) for frame in range(frameCount)]
+	workers = min(workers, frameCount, Runtime.getRuntime().availableProcessors())
+	if segmentation != "automatic" or workers < 2:
+		for task in tasks:
+			table = task.call()
+			log.extend(task.log)
+			if table is not None:
+				results.write(table)
+		return
+	pool = Executors.newFixedThreadPool(workers)
+	try:
+		futures = [pool.submit(task) for task in tasks]
+		for task, future in zip(tasks, futures):
+			table = future.get()
+			log.extend(task.log)
+			if table is not None:
+				results.write(table)
+	finally:
+		pool.shutdown()
 
 class imageProperties:
 	"""set of functions to identify the cells and nuclei in a given imp and measure the intensity of these relative to bg"""
-	def __init__(self):
+	def __init__(self, mode = "automatic", log = None, profile = None, image = ""):
+		self.log = log if log else imageLog()
+		self.profile = profile if profile else stageProfile()
+		self.image = image
 		self.images = {}
 		self.imageLabels = {}
 		self.cellOverlay = Overlay()
 		self.DAPIoverlay = Overlay()
+		self.mode = mode
+		self.foreground = None
+	
+	def autoBackground(self, cellLabel, cellMask):
+		"""darkest square tile of the cell channel free of any cell or nucleus"""
+		ip = self.images[cellLabel].getProcessor()
+		excluded = cellMask.duplicate()
+		if self.foreground is not None:
+			excluded.copyBits(self.foreground, 0, 0, Blitter.OR)
+		excluded.setColor(255)
+		for i in range(Overlay.size(self.DAPIoverlay) if self.DAPIoverlay else 0):
+			excluded.fill(self.DAPIoverlay.get(i))
+		size = max(8, min(ip.getWidth(), ip.getHeight()) // 16)
+		best, bestMean = None, None
+		for y in range(0, ip.getHeight() - size + 1, size):
+			for x in range(0, ip.getWidth() - size + 1, size):
+				tile = Rectangle(x, y, size, size)
+				excluded.setRoi(tile)
+				if IS.getStatistics(excluded, IS.MIN_MAX, None).max > 0:
+					continue
+				ip.setRoi(tile)
+				mean = IS.getStatistics(ip, IS.MEAN, None).mean
+				if bestMean is None or mean < bestMean:
+					best, bestMean = tile, mean
+		ip.resetRoi()
+		if best is None:
+			self.log.log("no cell free background tile found in image {0} frame {1}.".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
+			return None
+		return Roi(best.x, best.y, best.width, best.height)
+	
+	def autoCells(self, cellLabel, nucleusLabel):
+		"""segment the cells without user input, splitting the Otsu thresholded cell channel between the nuclei"""
+		cellImp = self.images[cellLabel]
+		width, height = cellImp.getWidth(), cellImp.getHeight()
+		ip = cellImp.getProcessor().duplicate()
+		ip.setAutoThreshold(AutoThresholder.Method.Otsu, True, ImageProcessor.NO_LUT_UPDATE)
+		self.foreground = ip.createMask()
+		seeds = binarize(self.images[nucleusLabel].duplicate(), "DAPI")
+		nuclei = analyzeParticles(seeds, 1500, 10000, 0.4)
+		if not nuclei or Overlay.size(nuclei) == 0:
+			self.log.log("no nuclei to seed the cell segmentation in image {0} frame {1}.".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
+			return Overlay()
+		seedMask = ByteProcessor(width, height)
+		seedMask.setColor(255)
+		for roi in nuclei:
+			seedMask.fill(roi)
+		distance = EDM().makeFloatEDM(seedMask, 255, False)
+		distance.multiply(-1)
+		regions = MaximumFinder().findMaxima(distance, 0.5, ImageProcessor.NO_THRESHOLD, MaximumFinder.SEGMENTED, False, False)
+		regions.copyBits(self.foreground, 0, 0, Blitter.AND)
+		self.foreground.copyBits(seedMask, 0, 0, Blitter.OR)
+		regions.setThreshold(255, 255, ImageProcessor.NO_LUT_UPDATE)
+		cells = analyzeParticles(ImagePlus("cells", regions), 1500, float("inf"), 0.0)
+		if not cells:
+			return Overlay()
+		cellImp.setOverlay(cells)
+		return cells
+	
+	def backgroundRoi(self, cellLabel, cellMask):
+		"""the bg rectangle: drawn by hand in manual mode, otherwise the darkest tile free of the cells in cellMask (checked by hand in review mode)"""
+		imp = self.images[cellLabel]
+		if self.mode == "manual":
+			self.itemID(imp, "bg", "r")
+			return imp.getOverlay().get(0) if imp.getOverlay() else None
+		bg = self.autoBackground(cellLabel, cellMask)
+		if self.mode == "review":
+			reviewed = self.reviewItems(imp, "bg", Overlay(bg) if bg else None, "r")
+			bg = reviewed.get(0) if reviewed else None
+		return bg
 	
 	def cytoplasmMaker(self, cellCount):
 		finalOverlay = Overlay()
@@ -200,13 +339,13 @@ class imageProperties:
 			finalOverlay.add(roi2)
 			finalOverlay.add(cytoplasm)
 		if Overlay.size(finalOverlay) == 0:
-			IJ.log("no transfected cells identified in image {0} frame {1} after overlap filtering".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
+			self.log.log("no transfected cells identified in image {0} frame {1} after overlap filtering".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
 			return None
 		finalCells = Overlay.size(finalOverlay)/3
 		if isinstance(finalCells, (int, long)):
-			IJ.log("{0} cells identified in image {1} frame {2} after filtering".format(finalCells, self.imageLabels['snapName'], self.imageLabels['snapNo']))
+			self.log.log("{0} cells identified in image {1} frame {2} after filtering".format(finalCells, self.imageLabels['snapName'], self.imageLabels['snapNo']))
 		else:
-			IJ.log("incorrect cell:nucleus:cytoplasm ratio in image {0} frame {1} after mask filtering".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
+			self.log.log("incorrect cell:nucleus:cytoplasm ratio in image {0} frame {1} after mask filtering".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
 			return None
 		return finalOverlay
 	
@@ -217,9 +356,9 @@ class imageProperties:
 		if "#" in imp.getTitle():
 			self.imageLabels['snapNo'] = imp.getTitle().split("#")[1]
 		else:
-			IJ.log("Unable to identify snap number, using entire image name instead.")
+			self.log.log("Unable to identify snap number, using entire image name instead.")
 			self.imageLabels['snapNo'] = imp.getTitle()
-		IJ.log("beginning processing of image {0} frame {1}".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
+		self.log.log("beginning processing of image {0} frame {1}".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
 		nucleusLabel = channels['nucleus'][0]
 		cellLabel = channels['cell'][0]
 		self.images[nucleusLabel] = ImagePlus(nucleusLabel, imp.getImageStack().getProcessor(channels['nucleus'][1])).duplicate()
@@ -243,53 +382,62 @@ class imageProperties:
 		wait.show()
 		imp.hide()
 		if wait.escPressed():
-			IJ.log("{0} drawing cancelled for image {1} frame {2}".format(item, self.imageLabels['snapName'], self.imageLabels['snapNo']))
+			self.log.log("{0} drawing cancelled for image {1} frame {2}".format(item, self.imageLabels['snapName'], self.imageLabels['snapNo']))
 			return
 		elif rm.getCount() == 0:
-			IJ.log("no {0} drawn for image {1} frame {2}".format(item, self.imageLabels['snapName'], self.imageLabels['snapNo']))
+			self.log.log("no {0} drawn for image {1} frame {2}".format(item, self.imageLabels['snapName'], self.imageLabels['snapNo']))
 			return
 		else:
-			IJ.log("{0} drawn for image {1} frame {2}".format(item, self.imageLabels['snapName'], self.imageLabels['snapNo']))
+			self.log.log("{0} drawn for image {1} frame {2}".format(item, self.imageLabels['snapName'], self.imageLabels['snapNo']))
 			rm.moveRoisToOverlay(imp)
 			rm.reset()
 			imp.hide()
 	
+	def matchCells(self):
+		"""pair each cell with one nucleus (see assignPairs) and drop every cell and nucleus left unpaired"""
+		cellMasks = [roiMask(self.cellOverlay.get(i)) for i in range(Overlay.size(self.cellOverlay))]
+		nucleusMasks = [roiMask(self.DAPIoverlay.get(i)) for i in range(Overlay.size(self.DAPIoverlay))]
+		nucleusIndex = roiIndex(nucleusMasks)
+		overlaps = {}
+		for cell, cellMask in enumerate(cellMasks):
+			for nucleus in nucleusIndex.candidates(cellMask[0]):
+				area = overlapArea(cellMask, nucleusMasks[nucleus])
+				if area > 0:
+					overlaps[(cell, nucleus)] = area
+		cellOverlay, DAPIoverlay = Overlay(), Overlay()
+		for k, (cell, nucleus) in enumerate(assignPairs(overlaps)):
+			cellRoi, nucleusRoi = self.cellOverlay.get(cell), self.DAPIoverlay.get(nucleus)
+			cellRoi.setName("cell_" + str(k))
+			nucleusRoi.setName("nucleus_" + str(k))
+			cellOverlay.add(cellRoi)
+			DAPIoverlay.add(nucleusRoi)
+		self.cellOverlay, self.DAPIoverlay = cellOverlay, DAPIoverlay
+		return Overlay.size(cellOverlay)
+	
 	def measureImage(self, imp, overlay, channels):
-		overlaySize = Overlay.size(overlay)
 		imp.setOverlay(overlay)
 		table = []
-		for label, channel in channels.items():
-			if label == 'nucleus' or label == 'cell':
-				continue
-			imp.setSlice(channel[1])
-			temp = []
-			for i in range(overlaySize):
-				roi = overlay.get(i)
-				roi.setImage(imp)
-				Rname = Roi.getName(roi)
-				roiStat = roi.getStatistics()
-				temp.append(self.imageLabels['snapName'])
-				temp.append(self.imageLabels['snapNo'])
-				temp.append(channel[0])
-				temp.append(Rname)
-				temp.append(roiStat.area)
-				temp.append(roiStat.mean)
-				temp.append(roiStat.median)
-			table.append(temp)
+		measured = [(channel[0], channel[1]) for label, channel in channels.items() if label != 'nucleus' and label != 'cell']
+		for label, i, roiStat in roiStatistics(imp, overlay, measured):
+			Rname = Roi.getName(overlay.get(i))
+			table.append([self.imageLabels['snapName'], self.imageLabels['snapNo'], label, Rname, roiStat.area, roiStat.mean, roiStat.median])
 		return table
 	
-	def nucleiFilter(self, cellPoints, cellCount, nucleiCount):
+	def nucleiFilter(self, cellMask, cellCount, nucleiCount, cellLabel, nucleusLabel):
 		"""iterate across all nuclei and delete those that don't overlap ChREBP-transfected cells"""
 		if cellCount < nucleiCount:
+			imageMask = (Rectangle(cellMask.getWidth(), cellMask.getHeight()), cellMask)
 			i = 0
 			while self.DAPIoverlay.contains(self.DAPIoverlay.get(i)):
 				roi = self.DAPIoverlay.get(i)
-				nucPoints = set(roi.getContainedPoints())
-				if len(cellPoints & nucPoints) < 0.9 * len(nucPoints):
+				nucMask = roiMask(roi)
+				if overlapArea(imageMask, nucMask) < 0.9 * nucMask[1].getHistogram()[255]:
 					self.DAPIoverlay.remove(roi)
 					nucleiCount -= 1
 					if nucleiCount == 0:
-						IJ.log("no nuclei found to be coincident with called transfected cells in image {0} frame {1}.".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
+						self.log.log("no nuclei found to be coincident with called transfected cells in image {0} frame {1}.".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
+						if self.mode == "automatic":
+							break
 						self.images[cellLabel].show()
 						self.itemID(self.images[nucleusLabel], "nuclei", "p")
 						self.images[cellLabel].hide()
@@ -299,190 +447,125 @@ class imageProperties:
 					i += 1
 		return nucleiCount
 	
-	def overlayMaker(self, cellLabel, nucleusLabel, width, height):
-		self.itemID(self.images[cellLabel], "cells", "p")
-		self.cellOverlay = self.images[cellLabel].getOverlay()
-		if not self.cellOverlay:
-			IJ.log("no cells found in image {0} frame {1}.".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
+	def overlayMaker(self, cellLabel, nucleusLabel, width, height, method = "label"):
+		"""make the cell and nucleus overlays; returns a mask of all cells with the cell and nucleus counts"""
+		if self.mode == "manual":
+			self.itemID(self.images[cellLabel], "cells", "p")
+			self.cellOverlay = self.images[cellLabel].getOverlay()
+		else:
+			self.cellOverlay = self.autoCells(cellLabel, nucleusLabel)
+			if self.mode == "review":
+				self.cellOverlay = self.reviewItems(self.images[cellLabel], "cells", self.cellOverlay, "p")
+		if not self.cellOverlay or Overlay.size(self.cellOverlay) == 0:
+			self.log.log("no cells found in image {0} frame {1}.".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
 			return None , None, None
 		cellCount = Overlay.size(self.cellOverlay)
-		cellRoi = ShapeRoi(self.cellOverlay.get(0))
-		for i in range(1, cellCount):
-			shape = ShapeRoi(self.cellOverlay.get(i))
-			cellRoi = cellRoi.or(shape)
-		cellPoints = set(cellRoi)
-		notCell = ShapeRoi(Roi(0, 0, width, height)).xor(cellRoi)
 		ip = self.images[nucleusLabel].getProcessor()
 		ip.setValue(0)
-		ip.setRoi(notCell)
-		ip.fill(ip.getMask())
+		if method == "shape":
+			cellRoi = ShapeRoi(self.cellOverlay.get(0))
+			for i in range(1, cellCount):
+				shape = ShapeRoi(self.cellOverlay.get(i))
+				cellRoi = cellRoi.or(shape)
+			cellMask = ByteProcessor(width, height)
+			cellMask.setColor(255)
+			cellMask.fill(cellRoi)
+			notCell = ShapeRoi(Roi(0, 0, width, height)).xor(cellRoi)
+			ip.setRoi(notCell)
+			ip.fill(ip.getMask())
+		else:
+			background = backgroundMask(labelImage(self.cellOverlay, width, height))
+			cellMask = background.duplicate()
+			cellMask.invert()
+			ip.resetRoi()
+			ip.fill(background)
 		binarize(self.images[nucleusLabel], "DAPI")
 		"""create an overlay of _all_ nuclei"""
-		IJ.run(self.images[nucleusLabel], "Analyze Particles...", "size=1500-10000 circularity=0.4-1.00 show=Overlay include")
-		self.DAPIoverlay = self.images[nucleusLabel].getOverlay()
-		if not self.DAPIoverlay:
-			IJ.log("no nuclei automatically called found in image {0} frame {1}.".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
+		self.DAPIoverlay = analyzeParticles(self.images[nucleusLabel], 1500, 10000, 0.4)
+		if not self.DAPIoverlay and self.mode != "automatic":
+			self.log.log("no nuclei automatically called found in image {0} frame {1}.".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
 			self.images[cellLabel].show()
 			self.itemID(self.images[nucleusLabel], "nuclei", "p")
 			self.images[cellLabel].hide()
 			self.DAPIoverlay = self.images[nucleusLabel].getOverlay()
 		if not self.DAPIoverlay:
-			IJ.log("no nuclei found in image {0} frame {1}.".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
+			self.log.log("no nuclei found in image {0} frame {1}.".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
 			return None , None, None
 		nucleiCount = Overlay.size(self.DAPIoverlay)
-		IJ.log("initial cells: {0}; initial nuclei: {1}".format(cellCount, nucleiCount))
+		self.log.log("initial cells: {0}; initial nuclei: {1}".format(cellCount, nucleiCount))
 		cellRoi = ShapeRoi(self.cellOverlay.get(0))
-		return cellPoints, cellCount, nucleiCount
+		return cellMask, cellCount, nucleiCount
 		
-	def roiFilter(self, cellCount, nucleiCount, outerType):
-		"""to identify which nucleus belongs to which cell or vice verse in cases of more than one possible nucleus per cell"""
-		if outerType == "cell":
-			outerOverlay, innerOverlay, outerCount, innerCount = self.cellOverlay, self.DAPIoverlay, cellCount, nucleiCount
-		else:
-			outerOverlay, innerOverlay, outerCount, innerCount = self.DAPIoverlay, self.cellOverlay, nucleiCount, cellCount
-		i = 0
-		while i < outerCount:
-			overlapIndex, overlapTestList = [], []
-			roi = outerOverlay.get(i)
-			outerPoints = roi.getContainedPoints()
-			j = 0
-			while j < innerCount:
-				roi2 = innerOverlay.get(j)
-				innerPoints = roi2.getContainedPoints()
-				overlapTest = len(set(outerPoints) & set(innerPoints))
-				if overlapTest != 0:
-					overlapIndex.append(j)
-					overlapTestList.append(overlapTest)
-				if j == innerCount - 1 and len(overlapIndex) == 1:
-					"""if a given cell/nucleus ovelaps exactly one nucleus/cell- label the respective cell & nucleus with matching
-					identifiers starting with the str unique"""
-					roi4 = innerOverlay.get(overlapIndex[0])
-					roi4.setName("unique" + outerType + str(i)+ str(j))
-					roi.setName("unique" + outerType + str(i)+ str(j))
-				if j == innerCount - 1 and len(overlapIndex) > 1:
-					"""if a given cell/nucleus ovelaps more than one nucleus/cell- label the respective cell-nucleus pair
-					with the greatest overlap with matching identifiers"""
-					maxInd = overlapTestList.index(max(overlapTestList))
-					tempMax = overlapIndex[maxInd]
-					roi4 = innerOverlay.get(tempMax)
-					if roi4.getName() is None:
-						roi4.setName(outerType + str(i)+ str(j))
-						roi.setName(outerType + str(i)+ str(j))
-					else:
-						"""if the labelled cell-nucleus pair happen to contain a unique cell-nucleus pair, it is unlikely to be a true
-						pair so assign matching identifiers to the cell-nucleus pair with the next smallest overlapping area"""
-						while "unique" in roi4.getName():
-							overlapIndex.remove(tempMax)
-							overlapTestList.remove(max(overlapTestList))
-							if len(overlapIndex) == 0:
-								break
-							maxInd = overlapTestList.index(max(overlapTestList))
-							tempMax = overlapIndex[maxInd]
-							roi4 = innerOverlay.get(tempMax)
-						if len(overlapIndex) > 0:
-							roi4.setName(outerType + str(i)+ str(j))
-							roi.setName(outerType + str(i)+ str(j))
-				j += 1
-			if len(overlapIndex) == 0:
-				outerOverlay.remove(roi)
-				outerCount -= 1
-			else:
-				if i == outerCount - 1:
-					for k in range(innerCount):
-						roi3 = innerOverlay.get(i)
-						if innerOverlay.contains(roi3) == True:
-							if roi3.getName() is None:
-								innerOverlay.remove(roi3)
-								innerCount -= 1
-								if innerOverlay == 0:
-									IJ.log("no single transfected cells overlapped a single transfected nucleus in image {0} frame {1}.".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
-									return None, None
-						else:
-							innerCount = k
-							break
-				i += 1
-		if outerType == "cell":
-			self.cellOverlay, self.DAPIoverlay, cellCount, nucleiCount = outerOverlay, innerOverlay, outerCount, innerCount
+	def reviewItems(self, imp, item, overlay, shape):
+		"""show automatically found objects in the ROI manager to be corrected, deleted or added to by hand; returns the corrected overlay"""
+		rm = RoiManager.getInstance()
+		if not rm:
+			rm = RoiManager()
+		rm.reset()
+		if overlay:
+			for roi in overlay:
+				rm.addRoi(roi)
+		imp.show()
+		rm.runCommand(imp, "Show All")
+		wait = WaitForUserDialog("", "Please check the " + item + ".\nCorrect or delete them in the ROI manager, press 't' to add more.")
+		if shape == "r":
+			IJ.setTool("rectangle")
 		else:
-			self.DAPIoverlay, self.cellOverlay, nucleiCount, cellCount = outerOverlay, innerOverlay, outerCount, innerCount
-		return cellCount, nucleiCount
-	
-	def unmatchedFilter(self, cellCount, nucleiCount):
-		"""to remove all cells that do not overlap with an precisely one nucleus and vice versa"""
-		for i in range(cellCount):
-			roi = self.cellOverlay.get(i)
-			Rname = roi.getName()
-			if self.DAPIoverlay.contains(self.DAPIoverlay.get(Rname)) == False:
-				roi.setName("unmatched" + str(i))
-		for i in range(nucleiCount):
-			roi = self.DAPIoverlay.get(i)
-			Rname = roi.getName()
-			if self.cellOverlay.contains(self.cellOverlay.get(Rname)) == False:
-				roi.setName("unmatched" + str(i))
-		for i in range(cellCount):
-			roi = self.cellOverlay.get(i)
-			Rname = roi.getName()
-			if "unmatched" in Rname:
-				for j in range(nucleiCount):
-					roi2 = self.DAPIoverlay.get(i)
-					if self.DAPIoverlay.contains(roi2) == True:
-						Rname2 = roi2.getName()
-						if "unmatched" in Rname2:
-							cellPoints = roi.getContainedPoints()
-							nucPoints = roi2.getContainedPoints()
-							overlapTest = bool(set(cellPoints) & set(nucPoints))
-							if overlapTest == True:
-								roi.setName("name" + str(i))
-								roi2.setName("name" + str(i))
-		i = 0
-		while i < cellCount:
-			roi = self.cellOverlay.get(i)
-			Rname = roi.getName()
-			roi2 = self.DAPIoverlay.get(Rname)
-			if self.DAPIoverlay.contains(roi2) == True:
-				roi.setName("cell_" + str(i))
-				roi2.setName("nucleus_" + str(i))
-				i += 1
-			else:
-				self.cellOverlay.remove(roi)
-				cellCount -= 1
-		return cellCount
+			IJ.setTool("polygon")
+		wait.show()
+		imp.hide()
+		if wait.escPressed():
+			self.log.log("{0} review cancelled for image {1} frame {2}".format(item, self.imageLabels['snapName'], self.imageLabels['snapNo']))
+			rm.reset()
+			return None
+		reviewed = Overlay()
+		for roi in rm.getRoisAsArray():
+			reviewed.add(roi)
+		rm.reset()
+		self.log.log("{0} {1} after review for image {2} frame {3}".format(Overlay.size(reviewed), item, self.imageLabels['snapName'], self.imageLabels['snapNo']))
+		if Overlay.size(reviewed) == 0:
+			return None
+		imp.setOverlay(reviewed)
+		return reviewed
 	
 	def imageProcessor(self, imp, width, height, channels):
 		"""function to run the other functions in this class and output an array of image measurements"""
 		self.imagePlusmaker(imp, channels)
 		nucleusLabel = channels['nucleus'][0]
 		cellLabel = channels['cell'][0]
-		cellPoints, cellCount, nucleiCount = self.overlayMaker(cellLabel, nucleusLabel, width, height)
-		if cellPoints is None:
+		with self.profile.time(self.image, "overlayMaker") as timer:
+			cellMask, cellCount, nucleiCount = self.overlayMaker(cellLabel, nucleusLabel, width, height)
+			timer.count = cellCount
+		if cellMask is None:
 			return None
-		nucleiCount = self.nucleiFilter(cellPoints, cellCount, nucleiCount)
+		with self.profile.time(self.image, "nucleiFilter") as timer:
+			nucleiCount = self.nucleiFilter(cellMask, cellCount, nucleiCount, cellLabel, nucleusLabel)
+			timer.count = nucleiCount
 		if nucleiCount == 0:
-			IJ.log("no nuclei found in image {0} frame {1}.".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
-			return None
-		cellCount, nucleiCount = self.roiFilter(cellCount, nucleiCount, "cell")
-		if cellCount == None:
-			return None
-		cellCount, nucleiCount = self.roiFilter(cellCount, nucleiCount, "DAPI")
-		if cellCount == None:
+			self.log.log("no nuclei found in image {0} frame {1}.".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
 			return None
-		cellCount = self.unmatchedFilter(cellCount, nucleiCount)
-		finalOverlay = self.cytoplasmMaker(cellCount)
+		with self.profile.time(self.image, "matchCells") as timer:
+			cellCount = self.matchCells()
+			timer.count = cellCount
+		with self.profile.time(self.image, "cytoplasmMaker"):
+			finalOverlay = self.cytoplasmMaker(cellCount)
 		if finalOverlay == None:
 			return None
-		self.itemID(self.images[cellLabel], "bg", "r")
-		bg = self.images[cellLabel].getOverlay().get(0)
+		with self.profile.time(self.image, "backgroundRoi"):
+			bg = self.backgroundRoi(cellLabel, cellMask)
 		if not bg:
-			IJ.log("no bg drawn for image {0} frame {1}.".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
+			self.log.log("no bg found for image {0} frame {1}.".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
 			return None
 		bg.setName("bg")
 		Overlay.add(finalOverlay, bg)
-		table = self.measureImage(imp, finalOverlay, channels)
+		with self.profile.time(self.image, "measureImage") as timer:
+			table = self.measureImage(imp, finalOverlay, channels)
+			timer.count = len(table)
 		if len(table) > 0:
 			return table
 		else:
-			IJ.log("table not generated for image {0} frame {1} even though transfected cells overlapped specific nuclei.".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
+			self.log.log("table not generated for image {0} frame {1} even though transfected cells overlapped specific nuclei.".format(self.imageLabels['snapName'], self.imageLabels['snapNo']))
 			return None
 
 if __name__ in ["__builtin__", "__main__"]:
-	processimagefile(imagefile)
+	processBatch(inputFiles, cacheDir, cacheLimit, showResults, segmentation, parallelScenes)
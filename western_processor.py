@@ -2,47 +2,245 @@
 saves the rotated cropped images in the input directory.
 Designed for uniformly processing multiple exposures of a blots/gel
 from a single imaging machine."""
-#@ File[] (label="Select westerns", style="file") myImages
+#@ File[] (label="Select westerns or directories of westerns", style="both") myImages
+#@ Boolean (label="low memory: show only the reference, stream the other images from disk", value=false) streaming
+#@ File (label="apply a saved transform instead of choosing a reference (optional)", style="file", required=false) transformFile
 
-from ij import IJ, WindowManager
-from ij.gui import GenericDialog, Roi, WaitForUserDialog
+from ij import IJ, ImagePlus, WindowManager
+from ij.gui import GenericDialog, PolygonRoi, Roi, WaitForUserDialog
 from ij.io import FileSaver
 from ij.plugin.filter import Rotator
 from ij.plugin.frame import RoiManager
+from ij.process import ByteProcessor, FloatPolygon
 
+from java.awt import GraphicsEnvironment, Rectangle
+from java.awt.geom import AffineTransform
+from java.awt.image import AffineTransformOp, BufferedImage
+
+from java.io import File, FileInputStream
+from java.security import MessageDigest
 from java.util import Date
+from jarray import array, zeros
 from os import path
+import json
+import math
 import re
 
 class rotateCrop:
 	def __init__(self):
 		self.angle = None
 		self.roi = int()
+		self.interpolation = "Bilinear"
+		self.reference = None
 
 	def refProcessing(self, imp):
-		"""process the refrence image and generate the roatation angle and roi used for cropping the subsequent images"""
+		"""process the refrence image and generate the roatation angle and roi used for cropping the subsequent images; None on esc"""
 		IJ.run("Rotate... ")
 		self.angle = Rotator.getAngle()
 		imp2 = imp.duplicate()
-		wait = WaitForUserDialog("", "Please outline the membrane.\nPress 't' to add to the ROI manager. \nPress esc to cancel.")
 		IJ.setTool("rectangle")
 		rm = RoiManager.getInstance()
 		if not rm:
 			rm = RoiManager()
 		rm.reset()
-		wait.show()
-		self.roi = rm.getRoi(0)
+		message = "Please outline the membrane.\nPress 't' to add to the ROI manager. \nPress esc to cancel."
+		self.roi = None
+		while self.roi is None:
+			wait = WaitForUserDialog("", message)
+			wait.show()
+			if wait.escPressed():
+				return None
+			#an outline drawn but not added to the ROI manager is taken as it is
+			self.roi = rm.getRoi(0) if rm.getCount() > 0 else imp.getRoi()
+			message = "No outline was found. Please outline the membrane.\nPress 't' to add to the ROI manager. \nPress esc to cancel."
 		imp.setRoi(self.roi)
 		imp2 = imp.crop()
 		return imp2
 
+	def cropRotate(self, imp):
+		"""rotate only the region of imp that ends up under the rectangular self.roi; None if the crop lies outside the image"""
+		width, height = imp.getWidth(), imp.getHeight()
+		crop = self.roi.getBounds().intersection(Rectangle(0, 0, width, height))
+		if crop.isEmpty():
+			return None
+		#source pixels of the crop corners, padded for the bilinear neighbours
+		cx, cy = (width - 1) / 2.0, (height - 1) / 2.0
+		ca, sa = math.cos(math.radians(-self.angle)), math.sin(math.radians(-self.angle))
+		corners = [(x - cx, y - cy) for x in (crop.x, crop.x + crop.width - 1) for y in (crop.y, crop.y + crop.height - 1)]
+		xs = [x * ca - y * sa + cx for x, y in corners]
+		ys = [x * sa + y * ca + cy for x, y in corners]
+		x0, y0 = max(0, int(math.floor(min(xs))) - 2), max(0, int(math.floor(min(ys))) - 2)
+		x1, y1 = min(width, int(math.ceil(max(xs))) + 3), min(height, int(math.ceil(max(ys))) + 3)
+		if x1 <= x0 or y1 <= y0:
+			return None
+		ip = imp.getProcessor()
+		ip.setRoi(x0, y0, x1 - x0, y1 - y0)
+		region = ip.crop()
+		ip.resetRoi()
+		imageType = BufferedImage.TYPE_BYTE_GRAY if isinstance(ip, ByteProcessor) else BufferedImage.TYPE_USHORT_GRAY
+		source = BufferedImage(region.getWidth(), region.getHeight(), imageType).getRaster()
+		source.setDataElements(0, 0, region.getWidth(), region.getHeight(), region.getPixels())
+		target = BufferedImage(crop.width, crop.height, imageType).getRaster()
+		#region -> full image -> rotated about the centre -> crop, java2d pixel centres lie at +0.5
+		transform = AffineTransform()
+		transform.translate(cx + 0.5 - crop.x, cy + 0.5 - crop.y)
+		transform.rotate(math.radians(self.angle))
+		transform.translate(x0 - 0.5 - cx, y0 - 0.5 - cy)
+		AffineTransformOp(transform, AffineTransformOp.TYPE_BILINEAR).filter(source, target)
+		ip2 = ip.createProcessor(crop.width, crop.height)
+		ip2.setPixels(target.getDataElements(0, 0, crop.width, crop.height, None))
+		imp2 = ImagePlus(imp.getTitle(), ip2)
+		imp2.setCalibration(imp.getCalibration())
+		return imp2
+
+	def load(self, filepath):
+		"""read the angle, crop and interpolation saved by save()"""
+		with open(filepath) as transformFile:
+			transform = json.load(transformFile)
+		self.angle, self.interpolation, self.reference = transform['angle'], transform['interpolation'], transform['reference']
+		crop = transform['roi']
+		if crop['type'] == "rectangle":
+			self.roi = Roi(crop['x'], crop['y'], crop['width'], crop['height'])
+		else:
+			self.roi = PolygonRoi(FloatPolygon(array(crop['xpoints'], 'f'), array(crop['ypoints'], 'f')), Roi.POLYGON)
+
 	def processImages(self, imp):
 		"""rotate and crop images based on the angles and roi defined by the reference image"""
-		IJ.run(imp, "Rotate... ", "angle="+str(self.angle)+ " grid=1 interpolation=Bilinear")
+		if imp.getStackSize() == 1 and imp.getBitDepth() in (8, 16) and self.roi.getType() == Roi.RECTANGLE and self.interpolation == "Bilinear":
+			imp2 = self.cropRotate(imp)
+			if imp2 is not None:
+				return imp2
+		IJ.run(imp, "Rotate... ", "angle="+str(self.angle)+ " grid=1 interpolation="+self.interpolation)
 		imp.setRoi(self.roi)
 		imp2 = imp.crop()
 		return imp2
 
+	def save(self, filepath, referencePath):
+		"""save the angle, crop and interpolation as json, with the sha1 of the reference image file they were defined on"""
+		self.reference = {'name': path.basename(referencePath), 'sha1': fileHash(referencePath)}
+		if self.roi.getType() == Roi.RECTANGLE:
+			bounds = self.roi.getBounds()
+			crop = {'type': "rectangle", 'x': bounds.x, 'y': bounds.y, 'width': bounds.width, 'height': bounds.height}
+		else:
+			polygon = self.roi.getFloatPolygon()
+			crop = {'type': "polygon", 'xpoints': list(polygon.xpoints)[:polygon.npoints], 'ypoints': list(polygon.ypoints)[:polygon.npoints]}
+		with open(filepath, 'w') as transformFile:
+			json.dump({'angle': self.angle, 'roi': crop, 'interpolation': self.interpolation, 'reference': self.reference}, transformFile, indent = 1)
+		print "transform saved at", filepath
+
+def fileHash(filepath):
+	"""sha1 of the file content"""
+	digest = MessageDigest.getInstance("SHA-1")
+	stream = FileInputStream(filepath)
+	buffer = zeros(1 << 20, 'b')
+	length = stream.read(buffer)
+	while length > 0:
+		digest.update(buffer, 0, length)
+		length = stream.read(buffer)
+	stream.close()
+	return "".join("%02x" % (b & 0xff) for b in digest.digest())
+
+def imageFinder(selected):
+	"""the selected files and the files in the selected directories, leaving out hidden files, transforms and earlier outputs"""
+	pathList = []
+	for chosen in selected:
+		if chosen.isDirectory():
+			pathList += sorted(image.getAbsolutePath() for image in chosen.listFiles() if image.isFile()
+				and not image.getName().startswith(".") and not image.getName().endswith(".json") and "_rotate_crop" not in image.getName())
+		else:
+			pathList.append(chosen.getAbsolutePath())
+	return pathList
+
+def processWesterns(myImagePaths, streaming, transformFile = None):
+	"""rotate and crop every image like the reference image chosen by the user, or as saved in transformFile, and save the results"""
+	if transformFile is not None:
+		#no reference and no dialogs, each image is saved next to itself
+		rc = rotateCrop()
+		rc.load(transformFile)
+		references = [i for i in myImagePaths if path.basename(i) == rc.reference['name']]
+		if not references:
+			print "warning:", rc.reference['name'], "is not among the selected images, so the transform's reference could not be checked"
+		if any(fileHash(i) != rc.reference['sha1'] for i in references):
+			print "Exiting.", rc.reference['name'], "is not the image the transform in", transformFile, "was made on (its sha1 differs)"
+		else:
+			print "applying the transform of", rc.reference['name'], "from", transformFile
+			stream(myImagePaths, rc)
+	elif streaming:
+		#open and show only the reference, the other images are streamed from disk after it
+		refPath = selectReference(myImagePaths)
+		imp = IJ.openImage(refPath) if refPath is not None else None
+		if refPath is None:
+			print "Exiting. No reference image was selected"
+		elif imp is None:
+			print "Exiting.", refPath, "could not be opened as an image"
+		else:
+			imp.show()
+			output = path.dirname(refPath) + path.sep
+			print "output directory:", output
+			imageName = re.split("\.\w{3}$", imp.getTitle())[0]
+			print "name of reference image:", imageName
+
+			rc = rotateCrop()
+			imp2 = rc.refProcessing(imp)
+			if imp2 is not None:
+				saver(imp2, output, imageName + "_rotate_crop")
+				rc.save(path.join(output, imageName + "_rotate_crop.json"), refPath)
+			imp.changes = False
+			imp.close()
+			if imp2 is None:
+				print "Exiting. No membrane was outlined on", imageName
+			else:
+				stream([i for i in myImagePaths if i != refPath], rc, output)
+	else:
+		#open images and show all
+		imps, imagePaths = [], []
+		for imagePath in myImagePaths:
+			imp = IJ.openImage(imagePath)
+			if imp is None:
+				print "skipping", imagePath, "which could not be opened as an image"
+				continue
+			imp.show()
+			imps.append(imp)
+			imagePaths.append(imagePath)
+		if imps == []:
+			print "Exiting. None of the selected files could be opened as an image"
+			return
+
+		output = IJ.getDirectory("image")
+		print "output directory:", output
+
+		#select a reference image. e.g. where the membrane is visible if a western,
+		picRef = WaitForUserDialog("", "Please select a reference blot.")
+		picRef.show()
+		imp = IJ.getImage()
+		imageName = re.split("\.\w{3}$", imp.getTitle())[0]
+		print "name of reference image:", imageName
+
+		#the path the reference was opened from, or recorded by ImageJ for an image opened otherwise
+		refPath = ([imagePath for other, imagePath in zip(imps, imagePaths) if other is imp] + [None])[0]
+		fileInfo = imp.getOriginalFileInfo()
+		if refPath is None and fileInfo is not None and fileInfo.directory:
+			refPath = path.join(fileInfo.directory, fileInfo.fileName)
+		rc = rotateCrop()
+		imp = rc.refProcessing(imp) if refPath is not None else None
+		if refPath is None:
+			print "Exiting.", imageName, "was not opened from a file, please select one of the opened images as the reference"
+		elif imp is None:
+			print "Exiting. No membrane was outlined on", imageName
+		else:
+			saver(imp, output, imageName + "_rotate_crop")
+			rc.save(path.join(output, imageName + "_rotate_crop.json"), refPath)
+			for imp in imps:
+				name = re.split("\.\w{3}$", imp.getTitle())[0]
+				if name != imageName:
+					imp2 = rc.processImages(imp)
+					saver(imp2, output, name + "_rotate_crop")
+		for imp in imps:
+			imp.changes = False
+			imp.close()
+
+	print "Image processing completed on", Date(), "."
+
 def saver(imp, output, name):
 	"""save image plus object as tiff under the path output + name"""
 	if path.exists(output) and path.isdir(output):
@@ -50,7 +248,13 @@ def saver(imp, output, name):
 		existTest = path.exists(filepath)
 	else:
 		print "Exiting.", output, "is not a valid directory"
-	if existTest:
+	if existTest and GraphicsEnvironment.isHeadless():
+		#nobody to ask, take the next free name-1, name-2...
+		level = 1
+		while path.exists(path.join(output, name + "-" + str(level) + ".tif")):
+			level += 1
+		filepath = path.join(output, name + "-" + str(level) + ".tif")
+	elif existTest:
 		gd = GenericDialog("results saver")
 		text = "a file is already located at " + filepath + ". Please choose a new name"
 		gd.addStringField(text, name + "-1")
@@ -63,35 +267,28 @@ def saver(imp, output, name):
 	FileSaver(imp).saveAsTiff(filepath)
 	print name, "saved successfully at ", str(filepath)
 
-#open images and show all
-myImagePaths = [str(i) for i in myImages]
-imps = [IJ.openImage(i) for i in myImagePaths]
-for imp in imps:
-	imp.show()
-
-output = IJ.getDirectory("image")
-print "output directory:", output
-
-#select a reference image. e.g. where the membrane is visible if a western,
-picRef = WaitForUserDialog("", "Please select a reference blot.")
-picRef.show()
-imp = IJ.getImage()
-imageName = re.split("\.\w{3}$", imp.getTitle())[0]
-print "name of reference image:", imageName
-
-rc = rotateCrop()
-imp = rc.refProcessing(imp)
-saver(imp, output, imageName + "_rotate_crop")
-
-for imp in imps:
-	name = re.split("\.\w{3}$", imp.getTitle())[0]
-	if name != imageName:
-		imp2 = rc.processImages(imp)
-		saver(imp2, output, name + "_rotate_crop")
-for imp in imps:
-	imp.changes = False
-	imp.close()
-
-print "Image processing completed on", Date(), "."
+def selectReference(paths):
+	"""ask for the reference image by file name; returns its path or None if cancelled"""
+	names = [path.basename(i) for i in paths]
+	gd = GenericDialog("reference image")
+	gd.addChoice("Please select a reference blot.", names, names[0])
+	gd.showDialog()
+	if gd.wasCanceled():
+		return None
+	return paths[gd.getNextChoiceIndex()]
 
+def stream(paths, rc, output = None):
+	"""open, rotate, crop, save and release the images one at a time so only one is held in memory"""
+	for imagePath in paths:
+		imp = IJ.openImage(imagePath)
+		if imp is None:
+			print "skipping", imagePath, "which could not be opened as an image"
+			continue
+		name = re.split("\.\w{3}$", imp.getTitle())[0]
+		imp2 = rc.processImages(imp)
+		saver(imp2, output or path.dirname(imagePath) + path.sep, name + "_rotate_crop")
+		imp2.flush()
+		imp.flush()
 
+if __name__ in ["__builtin__", "__main__"]:
+	processWesterns(imageFinder(myImages), streaming, None if transformFile is None else transformFile.getPath())